@@ -0,0 +1,102 @@
+"""Benchmark delta transfer of a lightly edited file: bytes on the wire and time.
+
+Usage: python bench_delta.py [--file-mb M] [--edits E]
+"""
+import argparse
+import contextlib
+import io
+import os
+import random
+import tempfile
+import threading
+import time
+import delta
+from client_core import ChatConnection
+from server import ChatServer
+
+def edit(data, edits, rng):
+    """A new version with a few scattered overwrites, insertions and deletions."""
+    data = bytearray(data)
+    for _ in range(edits):
+        pos = rng.randrange(len(data))
+        kind = rng.choice(("overwrite", "insert", "delete"))
+        if kind == "overwrite":
+            data[pos:pos + 100] = os.urandom(100)
+        elif kind == "insert":
+            data[pos:pos] = os.urandom(rng.randint(1, 200))
+        else:
+            del data[pos:pos + rng.randint(1, 200)]
+    return bytes(data)
+
+def bench_codec(old_path, new_path):
+    start = time.perf_counter()
+    sig = delta.signature(old_path)
+    signed = time.perf_counter()
+    out = io.BytesIO()
+    literal = delta.delta(new_path, sig, out)
+    encoded = time.perf_counter()
+    block_size, _ = delta.SIG_HEADER.unpack_from(sig)
+    out.seek(0)
+    with open(old_path, 'rb') as basis:
+        delta.patch(basis, out, lambda data: None, block_size)
+    patched = time.perf_counter()
+    return len(sig), len(out.getvalue()), literal, signed - start, encoded - signed, patched - encoded
+
+def bench_transfer(old_path, new_path, files_dir):
+    """Bytes the server relays for a full send of old_path, then a delta send of new_path."""
+    server = ChatServer("127.0.0.1", 0)
+    port = server.server.getsockname()[1]
+    threading.Thread(target=server.start, daemon=True).start()
+    alice = ChatConnection("127.0.0.1", port, "alice").connect()
+    bob = ChatConnection("127.0.0.1", port, "bob", files_dir=files_dir).connect()
+    received = threading.Semaphore(0)
+    threading.Thread(target=lambda: [received.release() for e in bob if e.kind == "file"], daemon=True).start()
+    threading.Thread(target=lambda: list(alice), daemon=True).start()
+
+    results = []
+    for path in (old_path, new_path):
+        # The path names differ; both versions go out as the same file
+        before = server.metrics["file_bytes"]
+        start = time.perf_counter()
+        with open(path, 'rb') as f, tempfile.TemporaryDirectory() as tmp:
+            version = os.path.join(tmp, "document.bin")
+            with open(version, 'wb') as out:
+                out.write(f.read())
+            alice.send_file("bob", version, delta=True)
+        received.acquire()
+        results.append((server.metrics["file_bytes"] - before, time.perf_counter() - start))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--file-mb", type=int, default=32)
+    parser.add_argument("--edits", type=int, default=10)
+    args = parser.parse_args()
+    rng = random.Random(439)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        old_path = os.path.join(tmp, "v1.bin")
+        new_path = os.path.join(tmp, "v2.bin")
+        old = os.urandom(args.file_mb * 1024 * 1024)
+        with open(old_path, 'wb') as f:
+            f.write(old)
+        new = edit(old, args.edits, rng)
+        with open(new_path, 'wb') as f:
+            f.write(new)
+
+        sig_size, delta_size, literal, sign_time, delta_time, patch_time = bench_codec(old_path, new_path)
+        # The server is chatty on stdout; keep the results readable
+        with contextlib.redirect_stdout(io.StringIO()):
+            (full_bytes, full_time), (delta_bytes, delta_send_time) = bench_transfer(
+                old_path, new_path, os.path.join(tmp, "received"))
+
+    print(f"File: {len(new) / 1024 / 1024:.1f} MB, {args.edits} edits")
+    print(f"Signature:   {sig_size / 1024:8.1f} KB  in {sign_time * 1000:7.1f} ms")
+    print(f"Delta:       {delta_size / 1024:8.1f} KB  in {delta_time * 1000:7.1f} ms ({literal:,} literal bytes)")
+    print(f"Patch:                   in {patch_time * 1000:7.1f} ms")
+    print(f"Relayed, full send:  {full_bytes:12,} bytes in {full_time * 1000:7.1f} ms")
+    print(f"Relayed, delta send: {delta_bytes:12,} bytes in {delta_send_time * 1000:7.1f} ms "
+          f"(signature + delta, {100 * (1 - delta_bytes / full_bytes):.1f}% fewer bytes)")
+
+if __name__ == "__main__":
+    main()
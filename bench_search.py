@@ -0,0 +1,84 @@
+"""Benchmark the server's search index: ingest rate, memory per message and query latency.
+
+Usage: python bench_search.py [--messages N] [--queries Q]
+"""
+import argparse
+import random
+import threading
+import time
+import tracemalloc
+from search import GENERAL, SearchIndex, private_conversation
+
+# Zipf-ish vocabulary: a few very common words and a long tail of rare ones
+VOCABULARY = [f"w{i}" for i in range(50000)]
+WEIGHTS = [1 / (rank + 1) for rank in range(len(VOCABULARY))]
+USERS = [f"user{i}" for i in range(200)]
+
+def synthetic_messages(count, rng):
+    words = rng.choices(VOCABULARY, WEIGHTS, k=count * 8)
+    for i in range(count):
+        sender = rng.choice(USERS)
+        if rng.random() < 0.2:
+            conversation = private_conversation(sender, rng.choice(USERS))
+        else:
+            conversation = GENERAL
+        # Two very common words that never share a message: the worst case for intersection
+        yield conversation, sender, " ".join(words[i * 8:(i + 1) * 8]) + (" alpha" if i % 2 else " beta")
+
+def percentile(samples, fraction):
+    return sorted(samples)[int(len(samples) * fraction)]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=1_000_000)
+    parser.add_argument("--queries", type=int, default=500)
+    args = parser.parse_args()
+    rng = random.Random(439)
+
+    index = SearchIndex()
+    tracemalloc.start()
+    start = time.perf_counter()
+    for conversation, sender, text in synthetic_messages(args.messages, rng):
+        index.add(conversation, sender, text)
+    ingest = time.perf_counter() - start
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    queries = {
+        "common word": lambda: rng.choice(VOCABULARY[:20]),
+        "rare word": lambda: rng.choice(VOCABULARY[1000:]),
+        "two words": lambda: f"{rng.choice(VOCABULARY[:200])} {rng.choice(VOCABULARY[:2000])}",
+        "disjoint": lambda: "alpha beta",
+    }
+    print(f"Indexed {args.messages:,} messages in {ingest:.1f} s "
+          f"({args.messages / ingest:,.0f} msg/s, {memory / args.messages:.0f} bytes/msg in memory; text is in the log)")
+    # Messages keep arriving while queries run; add() must not wait on them
+    stalls = [0.0]
+    querying = True
+    def keep_adding():
+        while querying:
+            start = time.perf_counter()
+            index.add(GENERAL, "writer", "incoming message")
+            stalls.append((time.perf_counter() - start) * 1000)
+            time.sleep(0.001)
+    writer = threading.Thread(target=keep_adding)
+    writer.start()
+
+    for label, make_query in queries.items():
+        samples = []
+        partial = 0
+        for _ in range(args.queries):
+            user = rng.choice(USERS)
+            query = make_query()
+            start = time.perf_counter()
+            _, cut_short = index.search(query, index.conversations_for(user), 20)
+            samples.append((time.perf_counter() - start) * 1000)
+            partial += cut_short
+        print(f"{label:12s} p50 {percentile(samples, 0.5):6.2f} ms   p99 {percentile(samples, 0.99):6.2f} ms"
+              f"   partial {100 * partial / args.queries:5.1f}%")
+    querying = False
+    writer.join()
+    print(f"add() during queries: max {max(stalls):.2f} ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""Benchmark TLS handshakes (full vs resumed) and file relay throughput.
+
+Usage: python bench_tls.py [--connections N] [--file-mb M]
+"""
+import argparse
+import contextlib
+import io
+import os
+import tempfile
+import threading
+import time
+import utils
+from server import ChatServer
+
+def start_server(certfile=None, keyfile=None):
+    server = ChatServer("127.0.0.1", 0, certfile, keyfile)
+    threading.Thread(target=server.start, daemon=True).start()
+    return server, server.server.getsockname()[1]
+
+def login(port, name, tls_context=None):
+    sock = utils.open_connection("127.0.0.1", port, tls_context, "localhost")
+    reader = utils.make_reader(sock)
+    utils.send_frame(sock, name.encode(utils.FORMAT))
+    utils.recv_msg(reader)  # Join broadcast; the TLS 1.3 ticket has arrived by now
+    return sock, reader
+
+def bench_handshakes(port, tls_context, connections, resume):
+    start = time.perf_counter()
+    for i in range(connections):
+        if not resume:
+            utils._tls_sessions.clear()
+        sock, reader = login(port, f"hs{resume:d}_{i}", tls_context)
+        if tls_context:
+            utils.save_tls_session(sock, "127.0.0.1", port)
+        reader.close()
+        sock.close()
+    return connections / (time.perf_counter() - start)
+
+def bench_relay(port, tls_context, size):
+    receiver, receiver_reader = login(port, "relay_rx", tls_context)
+    sender, sender_reader = login(port, "relay_tx", tls_context)
+    chunk = os.urandom(utils.RELAY_BUFFER_SIZE)
+
+    done = threading.Event()
+    def consume():
+        while True:
+            message = utils.recv_msg(receiver_reader)
+            if message.startswith(utils.HEADER_FILE):
+                remaining = size
+                while remaining > 0:
+                    remaining -= len(receiver_reader.read1(min(remaining, utils.RELAY_BUFFER_SIZE)))
+                done.set()
+                return
+    threading.Thread(target=consume, daemon=True).start()
+
+    start = time.perf_counter()
+    header = f"{utils.HEADER_FILE}{utils.SEPARATOR}relay_rx{utils.SEPARATOR}bench.bin{utils.SEPARATOR}{size}"
+    utils.send_frame(sender, header.encode(utils.FORMAT))
+    for _ in range(size // len(chunk)):
+        sender.sendall(chunk)
+    done.wait()
+    elapsed = time.perf_counter() - start
+
+    for sock, reader in ((sender, sender_reader), (receiver, receiver_reader)):
+        reader.close()
+        sock.close()
+    return size / elapsed / (1024 * 1024)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--connections", type=int, default=300)
+    parser.add_argument("--file-mb", type=int, default=64)
+    args = parser.parse_args()
+    size = args.file_mb * 1024 * 1024
+
+    with tempfile.TemporaryDirectory() as tmp:
+        certfile = os.path.join(tmp, "cert.pem")
+        keyfile = os.path.join(tmp, "key.pem")
+        utils.generate_self_signed_cert(certfile, keyfile)
+        tls_context = utils.make_client_context(certfile)
+
+        # The server is chatty on stdout; keep the results readable
+        with contextlib.redirect_stdout(io.StringIO()):
+            _, plain_port = start_server()
+            _, tls_port = start_server(certfile, keyfile)
+            plain_rate = bench_handshakes(plain_port, None, args.connections, False)
+            full_rate = bench_handshakes(tls_port, tls_context, args.connections, False)
+            resumed_rate = bench_handshakes(tls_port, tls_context, args.connections, True)
+            plain_relay = bench_relay(plain_port, None, size)
+            tls_relay = bench_relay(tls_port, tls_context, size)
+
+    print(f"Logins/s  plaintext:        {plain_rate:8.0f}")
+    print(f"Logins/s  TLS full:         {full_rate:8.0f}")
+    print(f"Logins/s  TLS resumed:      {resumed_rate:8.0f}")
+    print(f"Relay MB/s plaintext:       {plain_relay:8.1f}")
+    print(f"Relay MB/s TLS:             {tls_relay:8.1f}")
+
+if __name__ == "__main__":
+    main()
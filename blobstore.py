@@ -0,0 +1,123 @@
+import collections
+import os
+import re
+import tempfile
+import threading
+
+DIGEST_RE = re.compile(r"[0-9a-f]{64}\Z")  # sha256 hex; also keeps names inside the store
+UPLOAD_PREFIX = ".upload-"
+
+class BlobStoreFull(Exception):
+    """Raised when a blob can't fit without evicting blobs that still have readers."""
+
+class BlobStore:
+    """Content-addressed file store: each blob lives at <root>/<sha256 hex>.
+
+    Blobs are reference counted per outstanding delivery; referenced blobs are
+    pinned, unreferenced ones stay cached (so re-sends skip the upload) until
+    least-recently-used eviction keeps the store under max_bytes.
+    """
+
+    def __init__(self, root, max_bytes, clean=True):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()  # digest -> size, least recently used first
+        self.refs = collections.Counter()  # digest -> outstanding deliveries
+        self.total = 0
+        self.lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        self.rescan(clean)
+
+    def rescan(self, clean=False):
+        """Rebuild the index from the files on disk.
+
+        Blobs survive restarts; uploads interrupted by one don't, so clean
+        deletes leftover temp files. A hot-restarted server must not clean
+        before the handoff, while the old process may still be uploading.
+        """
+        existing = []
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if name.startswith(UPLOAD_PREFIX):
+                if clean:
+                    os.unlink(path)
+            elif DIGEST_RE.match(name):
+                stat = os.stat(path)
+                existing.append((stat.st_mtime, name, stat.st_size))
+        with self.lock:
+            self.entries.clear()
+            self.total = 0
+            for _, digest, size in sorted(existing):
+                self.entries[digest] = size
+                self.total += size
+
+    @staticmethod
+    def valid(digest):
+        return bool(DIGEST_RE.match(digest))
+
+    def path(self, digest):
+        return os.path.join(self.root, digest)
+
+    def __contains__(self, digest):
+        """Like has(), but without counting as a use."""
+        return digest in self.entries
+
+    def has(self, digest):
+        """True if the blob is stored; counts as a use for LRU purposes."""
+        with self.lock:
+            if digest not in self.entries:
+                return False
+            self.entries.move_to_end(digest)
+            return True
+
+    def new_upload(self):
+        """Temporary file for an incoming blob, on the same filesystem as the store."""
+        return tempfile.NamedTemporaryFile(dir=self.root, prefix=UPLOAD_PREFIX, delete=False)
+
+    def commit(self, tmp_path, digest, size):
+        """Move a verified upload into the store, evicting old blobs if needed."""
+        with self.lock:
+            if digest in self.entries:
+                os.unlink(tmp_path)
+                self.entries.move_to_end(digest)
+                return
+            if not self._make_room(size):
+                os.unlink(tmp_path)
+                raise BlobStoreFull(f"Blob store full ({self.total} of {self.max_bytes} bytes in use)")
+            os.replace(tmp_path, self.path(digest))
+            self.entries[digest] = size
+            self.total += size
+
+    def _make_room(self, size):
+        if size > self.max_bytes:
+            return False
+        for digest in list(self.entries):
+            if self.total + size <= self.max_bytes:
+                break
+            if self.refs[digest] == 0:
+                self.total -= self.entries.pop(digest)
+                os.unlink(self.path(digest))
+        return self.total + size <= self.max_bytes
+
+    def pin(self, digest, count=1):
+        """Take count references on a stored blob and return its size, or None if it isn't stored.
+
+        One lock hold, so a concurrent commit() can't evict the blob in between.
+        """
+        with self.lock:
+            size = self.entries.get(digest)
+            if size is None:
+                return None
+            self.entries.move_to_end(digest)
+            self.refs[digest] += count
+            return size
+
+    def acquire(self, digest, count=1):
+        with self.lock:
+            self.refs[digest] += count
+
+    def release(self, digest, count=1):
+        with self.lock:
+            self.refs[digest] -= count
+            if self.refs[digest] <= 0:
+                del self.refs[digest]
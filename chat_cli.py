@@ -0,0 +1,76 @@
+"""Command-line chat client for bots and scripts.
+
+Each line on stdin is sent as a message (privately with --to); incoming
+events are printed to stdout, one per line, as KIND<TAB>SENDER<TAB>TEXT.
+
+    echo "deploy finished" | python chat_cli.py --user ci-bot
+    python chat_cli.py --user ops --listen > chat.log
+    python chat_cli.py --user ci-bot --to alice --send-file build.zip
+    python chat_cli.py --user ci-bot --share-file build.zip   # whole room, uploaded once
+"""
+import argparse
+import sys
+import threading
+import time
+import utils
+from client_core import ChatConnection
+
+def print_events(conn, fetch_shared=False):
+    for event in conn:
+        fields = [event.kind, event.sender or "", event.text or ""]
+        if event.kind == "file":
+            fields.append(event.path or "")
+        elif event.kind in ("blob", "shared"):
+            fields.append(event.digest)
+            if event.kind == "blob" and fetch_shared:
+                conn.fetch(event.digest)
+        sys.stdout.write("\t".join(fields) + "\n")
+        sys.stdout.flush()
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless chat client")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=utils.PORT)
+    parser.add_argument("--user", required=True, help="Username to log in as")
+    parser.add_argument("--to", help="Send privately to this user instead of General")
+    parser.add_argument("--send-file", help="Send this file to --to, then continue with stdin")
+    parser.add_argument("--share-file", help="Share this file with --to (or General) via the server's store")
+    parser.add_argument("--fetch-shared", action="store_true", help="Download files shared with us")
+    parser.add_argument("--files-dir", help="Save incoming files here (default: discard)")
+    parser.add_argument("--listen", action="store_true", help="Keep printing events after stdin ends")
+    parser.add_argument("--tls", action="store_true", help="Connect over TLS")
+    parser.add_argument("--cafile", help="CA or self-signed server certificate to trust")
+    args = parser.parse_args()
+    if args.send_file and not args.to:
+        parser.error("--send-file requires --to")
+
+    tls_context = utils.make_client_context(args.cafile) if args.tls or args.cafile else None
+    conn = ChatConnection(args.host, args.port, args.user, tls_context, args.files_dir)
+    with conn:
+        printer = threading.Thread(target=print_events, args=(conn, args.fetch_shared), daemon=True)
+        printer.start()
+
+        if args.send_file:
+            conn.send_file(args.to, args.send_file, delta=True)
+        if args.share_file:
+            conn.share_file(args.to or "General", args.share_file)
+        for line in sys.stdin:
+            text = line.rstrip("\n")
+            if not text:
+                continue
+            if args.to:
+                conn.send_private(args.to, text)
+            else:
+                conn.send(text)
+
+        if args.listen:
+            printer.join()
+        # Shares finish in the background; wait until the server has confirmed them
+        while conn.offers and printer.is_alive():
+            time.sleep(0.05)
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass
@@ -1,68 +1,179 @@
+import time
+LAUNCHED_AT = time.perf_counter()  # Taken before the heavy imports so time-to-first-message is honest
+
 import sys
-import socket
+import argparse
+import json
 import threading
 import tkinter as tk
 from tkinter import simpledialog, scrolledtext, messagebox, filedialog
 import utils
 import os
 import subprocess
+from client_core import ChatConnection
+
+# Last-used host/port/username, so startup can connect without asking
+CONFIG_PATH = os.path.join(os.path.expanduser("~"), ".chat_client.json")
+
+def load_config():
+    try:
+        with open(CONFIG_PATH) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_config(config):
+    try:
+        with open(CONFIG_PATH, "w") as f:
+            json.dump(config, f)
+    except OSError as e:
+        utils.debug(f"Could not save {CONFIG_PATH}: {e}")
+
 
-print(f"Python Version: {sys.version}")
-try:
-    print(f"Tkinter Version: {tk.TkVersion}")
-except:
-    print("Tkinter Version: Unknown")
+class LoginDialog(simpledialog.Dialog):
+    """One dialog for server, port and username instead of three in a row."""
+
+    def __init__(self, parent, settings):
+        self.settings = settings
+        super().__init__(parent, "Connect")
+
+    def body(self, master):
+        self.entries = {}
+        fields = [
+            ("host", "Server IP:", self.settings.get("host", utils.HOST)),
+            ("port", "Server Port:", self.settings.get("port", utils.PORT)),
+            ("username", "Username:", self.settings.get("username", "")),
+        ]
+        for row, (key, label, value) in enumerate(fields):
+            tk.Label(master, text=label, anchor='w').grid(row=row, column=0, sticky='w', padx=5, pady=3)
+            entry = tk.Entry(master, width=28)
+            entry.insert(0, str(value))
+            entry.grid(row=row, column=1, padx=5, pady=3)
+            self.entries[key] = entry
+        return self.entries["username"] if not self.settings.get("username") else self.entries["host"]
+
+    def validate(self):
+        try:
+            int(self.entries["port"].get())
+        except ValueError:
+            messagebox.showwarning("Connect", "Port must be a number.", parent=self)
+            return False
+        return all(entry.get().strip() for entry in self.entries.values())
+
+    def apply(self):
+        self.result = {
+            "host": self.entries["host"].get().strip(),
+            "port": int(self.entries["port"].get()),
+            "username": self.entries["username"].get().strip(),
+        }
 
 
 class ChatClient:
-    def __init__(self):
-        self.sock = None
+    def __init__(self, tls_context=None, ask_login=False):
+        self.conn = None  # client_core.ChatConnection doing all the networking
         self.username = None
         self.running = False
+        self.tls_context = tls_context
+        self.sidebar_ready = False
+        self.pending_users = None  # User list that arrived before the sidebar was built
+        self.first_message_reported = False
+        self.logged_in = False
+        self.pending_shares = {}  # Map digest -> progress window state of files being shared
+        self.connect_done = None  # threading.Event set by the connect worker
         
         # Conversation management
         self.conversations = {"General": []}  # Track messages per conversation
         self.active_conversation = "General"  # Current active chat
         self.received_files = {}  # Track received files per conversation
         
-        # Create received_files directory
+        # client_core creates received_files/<sender>/ when the first file arrives
         self.files_dir = os.path.join(os.path.dirname(__file__), "received_files")
-        os.makedirs(self.files_dir, exist_ok=True)
+
+        # With remembered settings the connection starts before Tk is even up
+        self.config = load_config()
+        remembered = all(self.config.get(key) for key in ("host", "port", "username"))
+        if remembered and not ask_login:
+            self.connect_in_background(self.config)
         
         self.root = tk.Tk()
         self.root.withdraw() # Hide main window initially
 
-        self.login()
+        if self.connect_done is None:
+            if not self.login():
+                self.root.destroy()
+                return
         
-        if self.running:
-            self.root.deiconify() # Show main window
-            self.root.title(f"Chat Client - {self.username}")
-            self.root.geometry("900x600")
-            self.setup_gui()
-            self.root.protocol("WM_DELETE_WINDOW", self.on_close)
-            self.root.mainloop()
+        self.root.deiconify() # Show main window
+        self.root.title(f"Chat Client - {self.username} (connecting...)")
+        self.root.geometry("900x600")
+        self.setup_gui()
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
+        self.root.after(0, self.check_connection)
+        self.root.mainloop()
 
     def login(self):
-        # Simple dialogs for connection info
-        host = simpledialog.askstring("Connect", "Server IP:", initialvalue=utils.HOST)
-        port = simpledialog.askinteger("Connect", "Server Port:", initialvalue=utils.PORT)
-        self.username = simpledialog.askstring("Login", "Username:")
+        """Ask for connection info in one dialog and start connecting. Returns False if cancelled."""
+        dialog = LoginDialog(self.root, self.config)
+        if not dialog.result:
+            return False
+        self.connect_in_background(dialog.result)
+        return True
 
-        if host and port and self.username:
+    def connect_in_background(self, settings):
+        """Connect on a worker thread; check_connection() picks up the result on the Tk thread."""
+        self.username = settings["username"]
+        self.connect_settings = settings
+        self.connect_error = None
+        self.connect_done = threading.Event()
+
+        def connect():
             try:
-                self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                self.sock.connect((host, port))
-                
-                # Send username immediately
-                self.sock.send(self.username.encode(utils.FORMAT))
-                
-                self.running = True
-                
-                # Start listening thread
-                threading.Thread(target=self.receive_messages, daemon=True).start()
+                # Connects and sends the username immediately
+                self.conn = ChatConnection(
+                    settings["host"], int(settings["port"]), self.username, self.tls_context, self.files_dir
+                ).connect()
             except Exception as e:
-                messagebox.showerror("Connection Error", f"Could not connect: {e}")
+                self.connect_error = e
+            self.connect_done.set()
+
+        threading.Thread(target=connect, daemon=True).start()
+
+    def check_connection(self):
+        if not self.connect_done.is_set():
+            self.root.after(20, self.check_connection)
+            return
+
+        if self.connect_error:
+            messagebox.showerror("Connection Error", f"Could not connect: {self.connect_error}")
+            if self.login():
+                self.root.title(f"Chat Client - {self.username} (connecting...)")
+                self.root.after(20, self.check_connection)
+            else:
                 self.root.destroy()
+            return
+
+        self.running = True
+        self.root.title(f"Chat Client - {self.username}")
+        elapsed = (time.perf_counter() - LAUNCHED_AT) * 1000
+        print(f"[STARTUP] Connected after {elapsed:.0f} ms")
+        self.logged_in = False  # Until the server accepts the username; see login_accepted()
+        
+        # Start listening thread
+        threading.Thread(target=self.receive_messages, daemon=True).start()
+
+    def login_accepted(self):
+        """Only remember settings the server has accepted, so a taken name isn't reused next launch"""
+        save_config(self.connect_settings)
+        self.send_btn.config(state=tk.NORMAL)
+
+    def login_rejected(self, reason):
+        """The server refused the login (e.g. name taken); ask again instead of leaving a dead window"""
+        self.running = False
+        self.conn.close()
+        messagebox.showerror("Login Failed", reason)
+        if self.login():
+            self.root.title(f"Chat Client - {self.username} (connecting...)")
+            self.root.after(20, self.check_connection)
         else:
             self.root.destroy()
 
@@ -84,65 +195,11 @@ class ChatClient:
         self.root.configure(bg=self.colors['background'])
         
         # Main container
-        main_container = tk.Frame(self.root, bg=self.colors['background'])
-        main_container.pack(fill=tk.BOTH, expand=True)
-        
-        # Left Sidebar - Conversation List
-        self.sidebar = tk.Frame(main_container, bg=self.colors['sidebar'], width=220)
-        self.sidebar.pack(side=tk.LEFT, fill=tk.Y)
-        self.sidebar.pack_propagate(False)
-        
-        # Sidebar header
-        sidebar_header = tk.Label(
-            self.sidebar, 
-            text="CONVERSATIONS",
-            bg=self.colors['sidebar'],
-            fg=self.colors['text_light'],
-            font=('Helvetica', 10, 'bold'),
-            anchor='w',
-            padx=15,
-            pady=10
-        )
-        sidebar_header.pack(fill=tk.X)
-        
-        # Conversation buttons container
-        self.conv_buttons_frame = tk.Frame(self.sidebar, bg=self.colors['sidebar'])
-        self.conv_buttons_frame.pack(fill=tk.BOTH, expand=True, padx=5)
-        
-        # General chat button (always present)
-        self.create_conversation_button("General", self.colors['primary'])
-        
-        # Separator for online users
-        separator = tk.Frame(self.sidebar, bg=self.colors['sidebar'], height=2)
-        separator.pack(fill=tk.X, pady=10)
-        
-        online_label = tk.Label(
-            self.sidebar,
-            text="ONLINE USERS",
-            bg=self.colors['sidebar'],
-            fg=self.colors['text_light'],
-            font=('Helvetica', 9, 'bold'),
-            anchor='w',
-            padx=15,
-            pady=5
-        )
-        online_label.pack(fill=tk.X)
-        
-        # User list
-        self.user_listbox = tk.Listbox(
-            self.sidebar,
-            bg=self.colors['sidebar'],
-            fg=self.colors['text_light'],
-            selectbackground=self.colors['private'],
-            font=('Helvetica', 11),
-            borderwidth=0,
-            highlightthickness=0
-        )
-        self.user_listbox.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
-        self.user_listbox.bind('<Double-Button-1>', self.open_private_chat)
+        self.main_container = tk.Frame(self.root, bg=self.colors['background'])
+        self.main_container.pack(fill=tk.BOTH, expand=True)
         
         # Right side - Chat Area
-        self.chat_container = tk.Frame(main_container, bg=self.colors['background'])
+        self.chat_container = tk.Frame(self.main_container, bg=self.colors['background'])
         self.chat_container.pack(side=tk.RIGHT, fill=tk.BOTH, expand=True)
         
         # Chat header
@@ -159,6 +216,19 @@ class ChatClient:
             anchor='w',
             padx=20
         )
+        # Search box: Return sends a SEARCH, hits open in a results window
+        self.search_entry = tk.Entry(
+            self.chat_header,
+            font=('Helvetica', 11),
+            width=24,
+            borderwidth=0,
+            relief=tk.FLAT
+        )
+        self.search_entry.insert(0, "Search messages...")
+        self.search_entry.bind("<FocusIn>", lambda e: self.search_entry.delete(0, tk.END))
+        self.search_entry.bind("<Return>", self.search_messages)
+        self.search_entry.pack(side=tk.RIGHT, padx=15, ipady=4)
+        
         self.chat_title.pack(fill=tk.BOTH, expand=True)
         
         # Chat messages area
@@ -201,6 +271,7 @@ class ChatClient:
         self.send_btn = tk.Button(
             self.input_frame,
             text="Send",
+            state=tk.DISABLED,  # Enabled once connected
             command=self.send_message,
             bg=self.colors['primary'],
             fg=self.colors['text_light'],
@@ -224,6 +295,68 @@ class ChatClient:
         )
         self.file_btn.pack(side=tk.LEFT, padx=(5, 0), ipady=5)
 
+        # Paint the chat pane first; the sidebar is built once the window is on screen
+        self.root.update_idletasks()
+        self.root.after_idle(self.setup_sidebar)
+
+    def setup_sidebar(self):
+        # Left Sidebar - Conversation List
+        self.sidebar = tk.Frame(self.main_container, bg=self.colors['sidebar'], width=220)
+        self.sidebar.pack(side=tk.LEFT, fill=tk.Y, before=self.chat_container)
+        self.sidebar.pack_propagate(False)
+        
+        # Sidebar header
+        sidebar_header = tk.Label(
+            self.sidebar, 
+            text="CONVERSATIONS",
+            bg=self.colors['sidebar'],
+            fg=self.colors['text_light'],
+            font=('Helvetica', 10, 'bold'),
+            anchor='w',
+            padx=15,
+            pady=10
+        )
+        sidebar_header.pack(fill=tk.X)
+        
+        # Conversation buttons container
+        self.conv_buttons_frame = tk.Frame(self.sidebar, bg=self.colors['sidebar'])
+        self.conv_buttons_frame.pack(fill=tk.BOTH, expand=True, padx=5)
+        
+        # Separator for online users
+        separator = tk.Frame(self.sidebar, bg=self.colors['sidebar'], height=2)
+        separator.pack(fill=tk.X, pady=10)
+        
+        online_label = tk.Label(
+            self.sidebar,
+            text="ONLINE USERS",
+            bg=self.colors['sidebar'],
+            fg=self.colors['text_light'],
+            font=('Helvetica', 9, 'bold'),
+            anchor='w',
+            padx=15,
+            pady=5
+        )
+        online_label.pack(fill=tk.X)
+        
+        # User list
+        self.user_listbox = tk.Listbox(
+            self.sidebar,
+            bg=self.colors['sidebar'],
+            fg=self.colors['text_light'],
+            selectbackground=self.colors['private'],
+            font=('Helvetica', 11),
+            borderwidth=0,
+            highlightthickness=0
+        )
+        self.user_listbox.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
+        self.user_listbox.bind('<Double-Button-1>', self.open_private_chat)
+
+        self.sidebar_ready = True
+        # Catch up on anything that arrived while the sidebar was pending
+        self.refresh_conversation_buttons()
+        if self.pending_users is not None:
+            self._update_user_list_impl(self.pending_users)
+
     def create_conversation_button(self, name, color):
         """Create a conversation button in the sidebar"""
         is_active = (name == self.active_conversation)
@@ -252,6 +385,9 @@ class ChatClient:
 
     def refresh_conversation_buttons(self):
         """Refresh all conversation buttons to reflect active state"""
+        if not self.sidebar_ready:
+            return
+        
         for widget in self.conv_buttons_frame.winfo_children():
             widget.destroy()
         
@@ -274,23 +410,13 @@ class ChatClient:
         self.chat_header.config(bg=header_color)
         self.chat_title.config(bg=header_color, text=header_text)
         
-        # Update file button state
-        if is_private:
-            # Enable file sending in private chats
-            self.file_btn.config(
-                bg=self.colors['success'],
-                fg=self.colors['text_light'],
-                text="📎 Send File",
-                state=tk.NORMAL
-            )
-        else:
-            # Disable file sending in general chat
-            self.file_btn.config(
-                bg='#9E9E9E',
-                fg='#CCCCCC',
-                text="📎 File (DM only)",
-                state=tk.NORMAL  # Keep clickable to show warning
-            )
+        # Update file button; in General a file is shared with the whole room
+        self.file_btn.config(
+            bg=self.colors['success'],
+            fg=self.colors['text_light'],
+            text="📎 Send File" if is_private else "📎 Share File",
+            state=tk.NORMAL
+        )
         
         # Refresh conversation buttons
         self.refresh_conversation_buttons()
@@ -301,7 +427,10 @@ class ChatClient:
         
         if conv_name in self.conversations:
             for msg_data in self.conversations[conv_name]:
-                self._insert_message(msg_data['text'], msg_data.get('tag'))
+                if msg_data.get('callback'):
+                    self._insert_clickable_file(msg_data['text'], msg_data['callback'])
+                else:
+                    self._insert_message(msg_data['text'], msg_data.get('tag'))
         
         self.chat_area.config(state='disabled')
 
@@ -320,93 +449,68 @@ class ChatClient:
             self.switch_conversation(target)
 
     def receive_messages(self):
-        while self.running:
-            try:
-                message = self.sock.recv(utils.BUFFER_SIZE).decode(utils.FORMAT)
-                if not message:
-                    print("[DEBUG] Connection closed by server")
+        try:
+            for event in self.conn:
+                if not self.running:
                     break
-                
-                print(f"[DEBUG] Received raw: {message}")
-
-                # Check for headers
-                if utils.SEPARATOR in message:
-                    header, content = message.split(utils.SEPARATOR, 1)
-                    
-                    if header == utils.HEADER_MSG:
-                        self.display_message(content, "General", tag='system')
-                    elif header == utils.HEADER_PVT:
-                        # Parse private message: "[Private from Sender]: Message"
-                        # Extract sender from the message
-                        if content.startswith("[Private from "):
-                            sender_end = content.index("]:")
-                            sender = content[14:sender_end]
-                            actual_msg = content[sender_end+2:].strip()
-                            
-                            # Create conversation if needed
-                            if sender not in self.conversations:
-                                self.conversations[sender] = []
-                                self.root.after(0, self.refresh_conversation_buttons)
-                            
-                            self.display_message(f"{sender}: {actual_msg}", sender, tag='private')
-                        else:
-                            self.display_message(content, "General", tag='private')
-                    elif header == utils.HEADER_FILE:
-                        # Format: FILE<SEP>Sender<SEP>Filename<SEP>FileSize
-                        sender, filename, filesize = content.split(utils.SEPARATOR)
-                        filesize = int(filesize)
-                        self.receive_file(sender, filename, filesize)
-                    elif header == utils.HEADER_LIST:
-                        self.update_user_list(content)
-                    elif header == utils.HEADER_ERR:
-                        messagebox.showerror("Error", content)
-                else:
-                    self.display_message(message, "General")
+                utils.debug(f"Received event: {event}")
 
-            except OSError:
-                break
-            except Exception as e:
-                print(f"Error receiving: {e}")
-                break
+                if not self.logged_in:
+                    # A refused login gets one ERR and then the connection closes
+                    if event.kind == "error":
+                        self.root.after(0, lambda reason=event.text: self.login_rejected(reason))
+                        return
+                    self.logged_in = True
+                    self.root.after(0, self.login_accepted)
 
-    def receive_file(self, sender, filename, filesize):
-        """Automatically receive and save files"""
-        try:
-            # Create sender-specific directory
-            sender_dir = os.path.join(self.files_dir, sender)
-            os.makedirs(sender_dir, exist_ok=True)
-            
-            # Save file
-            save_path = os.path.join(sender_dir, filename)
-            
-            # Handle duplicate filenames
-            base, ext = os.path.splitext(save_path)
-            counter = 1
-            while os.path.exists(save_path):
-                save_path = f"{base}_{counter}{ext}"
-                counter += 1
-            
-            with open(save_path, 'wb') as f:
-                remaining = filesize
-                while remaining > 0:
-                    chunk_size = min(remaining, utils.BUFFER_SIZE)
-                    data = self.sock.recv(chunk_size)
-                    if not data:
-                        break
-                    f.write(data)
-                    remaining -= len(data)
-            
-            # Create conversation if needed
-            if sender not in self.conversations:
-                self.conversations[sender] = []
-                self.root.after(0, self.refresh_conversation_buttons)
-            
-            # Display clickable file link
-            self.display_file_link(sender, filename, save_path, filesize)
-            
+                if not self.first_message_reported and event.kind in ("message", "private"):
+                    self.first_message_reported = True
+                    elapsed = (time.perf_counter() - LAUNCHED_AT) * 1000
+                    print(f"[STARTUP] Time to first message: {elapsed:.0f} ms")
+
+                if event.kind == "message":
+                    self.display_message(event.text, "General", tag='system', msg_id=event.id)
+                elif event.kind == "private":
+                    if event.sender:
+                        # Create conversation if needed
+                        if event.sender not in self.conversations:
+                            self.conversations[event.sender] = []
+                            self.root.after(0, self.refresh_conversation_buttons)
+                        
+                        self.display_message(f"{event.sender}: {event.text}", event.sender, tag='private', msg_id=event.id)
+                    else:
+                        self.display_message(event.text, "General", tag='private')
+                elif event.kind == "file":
+                    self.receive_file(event.sender, event.text, event.path, event.size)
+                elif event.kind == "blob":
+                    self.root.after(0, lambda event=event: self.display_download_link(event))
+                elif event.kind == "shared":
+                    self.root.after(0, lambda event=event: self.finish_share(event))
+                elif event.kind == "users":
+                    self.update_user_list(event.text)
+                elif event.kind == "error":
+                    if event.digest:
+                        # A failed share; close its progress window
+                        self.root.after(0, lambda digest=event.digest: self.cancel_share(digest))
+                    messagebox.showerror("Error", event.text)
+                elif event.kind == "search":
+                    self.root.after(0, lambda event=event: self.show_search_results(event.text, event.hits, event.partial))
+            else:
+                utils.debug("Connection closed by server")
+        except OSError:
+            pass
         except Exception as e:
-            print(f"Error receiving file: {e}")
-            messagebox.showerror("File Error", f"Failed to receive file: {e}")
+            print(f"Error receiving: {e}")
+
+    def receive_file(self, sender, filename, save_path, filesize):
+        """Show a file the connection has already saved under received_files/<sender>/"""
+        # Create conversation if needed
+        if sender not in self.conversations:
+            self.conversations[sender] = []
+            self.root.after(0, self.refresh_conversation_buttons)
+        
+        # Display clickable file link
+        self.display_file_link(sender, filename, save_path, filesize)
 
     def display_file_link(self, sender, filename, filepath, filesize):
         """Display a clickable file link in the chat"""
@@ -468,25 +572,76 @@ class ChatClient:
 
     def send_message(self, event=None):
         msg = self.msg_entry.get()
-        if msg:
+        if msg and self.running:
             if self.active_conversation != "General":
                 # Send private message
                 target = self.active_conversation
-                full_msg = f"{target}{utils.SEPARATOR}{msg}"
-                utils.send_msg(self.sock, utils.HEADER_PVT, full_msg)
+                self.conn.send_private(target, msg)
                 self.display_message(f"You: {msg}", target, tag='sent')
             else:
                 # Broadcast to general
-                utils.send_msg(self.sock, utils.HEADER_MSG, msg)
+                self.conn.send(msg)
                 self.display_message(f"You: {msg}", "General", tag='sent')
             
             self.msg_entry.delete(0, tk.END)
 
-    def send_file(self):
-        if self.active_conversation == "General":
-            messagebox.showwarning("File Transfer", "Please open a private chat to send a file.")
+    def display_download_link(self, event):
+        """Show a file shared through the server; clicking the link downloads it"""
+        size_kb = event.size / 1024
+        size_str = f"{size_kb:.1f} KB" if size_kb < 1024 else f"{size_kb/1024:.1f} MB"
+        msg = f"📎 {event.sender} shared {event.text} ({size_str}) - click to download"
+        conv = event.conversation or event.sender
+        if conv not in self.conversations:
+            self.conversations[conv] = []
+            self.refresh_conversation_buttons()
+        
+        def download():
+            if self.running:
+                self.conn.fetch(event.digest)
+        
+        self.conversations[conv].append({'text': msg, 'tag': 'file', 'callback': download})
+        if self.active_conversation == conv:
+            self._insert_clickable_file(msg, download)
+
+    def finish_share(self, event):
+        """Close the progress window of a share the server has delivered"""
+        share = self.pending_shares.pop(event.digest, None)
+        if share is None:
+            return
+        progress_window, status_label, target, sent_msg = share
+        if event.size:
+            status_label.config(text="✓ File sent successfully!", fg='#43B581')
+        else:
+            status_label.config(text="✓ Server already had this file, no upload needed", fg='#43B581')
+        progress_window.after(1500, progress_window.destroy)
+        self.display_message(sent_msg, target, tag='file')
+
+    def send_direct(self, target, filename, filesize, on_progress, progress_window, status_label, sent_msg):
+        """Runs in a thread: the delta handshake waits on the receive thread"""
+        try:
+            total_sent = self.conn.send_file(target, filename, on_progress, delta=True)
+        except Exception as e:
+            print(f"[ERROR] File send failed: {e}")
+            self.root.after(0, progress_window.destroy)
+            self.root.after(0, lambda: messagebox.showerror("File Transfer Failed", f"Error sending file:\n{str(e)}"))
             return
+        utils.debug(f"Sent {total_sent} bytes.")
         
+        def finish():
+            if total_sent < filesize:
+                status_label.config(text=f"✓ Sent only the changes ({total_sent / 1024:.1f} KB)", fg='#43B581')
+            else:
+                status_label.config(text="✓ File sent successfully!", fg='#43B581')
+            progress_window.after(1500, progress_window.destroy)
+            self.display_message(sent_msg, target, tag='file')
+        self.root.after(0, finish)
+
+    def cancel_share(self, digest):
+        share = self.pending_shares.pop(digest, None)
+        if share is not None:
+            share[0].destroy()
+
+    def send_file(self):
         target = self.active_conversation
         filename = filedialog.askopenfilename(title=f"Select file to send to {target}")
         
@@ -514,7 +669,6 @@ class ChatClient:
             bg_color = '#F8F9FA'
             text_color = '#23272A'
             primary_color = '#5865F2'
-            success_color = '#43B581'
             
             progress_window.configure(bg=bg_color)
             
@@ -549,7 +703,7 @@ class ChatClient:
             
             status_label = tk.Label(
                 progress_window,
-                text="Preparing to send...",
+                text="Checking whether the server already has it...",
                 font=('Helvetica', 10, 'bold'),
                 bg=bg_color,
                 fg=primary_color
@@ -558,47 +712,31 @@ class ChatClient:
             
             progress_window.update()
             
-            # Send Header: FILE<SEP>Target<SEP>Filename<SEP>FileSize
-            header = f"{utils.HEADER_FILE}{utils.SEPARATOR}{target}{utils.SEPARATOR}{basename}{utils.SEPARATOR}{filesize}"
-            print(f"[DEBUG] Sending file header: {header}")
-            self.sock.send(header.encode(utils.FORMAT))
+            last_update = [0]
+            sent_msg = f"📎 Sent file: {basename} ({size_str})"
             
-            status_label.config(text="Transferring file data...")
-            progress_window.update()
-            
-            # Wait a bit to ensure server processes header before receiving raw bytes
-            import time
-            time.sleep(0.2)
-
-            # Send File Data
-            print(f"[DEBUG] Sending file content...")
-            total_sent = 0
-            last_update = 0
-            
-            with open(filename, 'rb') as f:
-                while True:
-                    bytes_read = f.read(utils.BUFFER_SIZE)
-                    if not bytes_read:
-                        break
-                    self.sock.send(bytes_read)
-                    total_sent += len(bytes_read)
-                    
-                    # Update progress (throttle updates to avoid UI lag)
-                    percentage = int((total_sent / filesize) * 100)
-                    if percentage - last_update >= 5 or total_sent == filesize:
-                        status_label.config(text=f"Sending... {percentage}%")
-                        progress_window.update()
-                        last_update = percentage
-            
-            print(f"[DEBUG] Sent {total_sent} bytes.")
-            
-            # Show completion
-            status_label.config(text="✓ File sent successfully!", fg=success_color)
-            progress_window.update()
-            time.sleep(1.5)
+            def on_progress(total_sent, total):
+                # Called from a sending thread; throttle and hand updates to Tk
+                percentage = int((total_sent / total) * 100)
+                if percentage - last_update[0] >= 5 or total_sent == total:
+                    last_update[0] = percentage
+                    self.root.after(0, lambda: status_label.config(text=f"Uploading... {percentage}%"))
             
-            progress_window.destroy()
-            self.display_message(f"📎 Sent file: {basename} ({size_str})", target, tag='file')
+            if target == "General":
+                # Offer the file's hash; it's only uploaded if the server asks for it
+                utils.debug(f"Sharing file {basename} with {target}...")
+                digest = self.conn.share_file(target, filename, on_progress)
+                # finish_share() completes this when the server confirms delivery
+                self.pending_shares[digest] = (progress_window, status_label, target, sent_msg)
+            else:
+                # Direct send; only the changes go if target has an earlier version
+                utils.debug(f"Sending file {basename} to {target}...")
+                status_label.config(text=f"Comparing with {target}'s copy...")
+                threading.Thread(
+                    target=self.send_direct,
+                    args=(target, filename, filesize, on_progress, progress_window, status_label, sent_msg),
+                    daemon=True
+                ).start()
             
         except Exception as e:
             import traceback
@@ -610,17 +748,77 @@ class ChatClient:
                 pass
             messagebox.showerror("File Transfer Failed", f"Error sending file:\n{str(e)}")
 
-    def display_message(self, message, conversation, tag=None):
+    def display_message(self, message, conversation, tag=None, msg_id=None):
         """Add message to conversation history and display if active"""
         if conversation not in self.conversations:
             self.conversations[conversation] = []
         
-        self.conversations[conversation].append({'text': message, 'tag': tag})
+        # msg_id is the server's search index id, when the message has one
+        self.conversations[conversation].append({'text': message, 'tag': tag, 'id': msg_id})
         
         # Only display if this is the active conversation
         if self.active_conversation == conversation:
             self.root.after(0, lambda: self._insert_message(message, tag))
 
+    def search_messages(self, event=None):
+        query = self.search_entry.get().strip()
+        if query and self.running:
+            self.conn.search(query)
+
+    def show_search_results(self, query, hits, partial=False):
+        """List search hits; double-click or Return jumps to one"""
+        results = tk.Toplevel(self.root)
+        results.title(f"Search: {query}")
+        results.geometry("500x300")
+        results.transient(self.root)
+        
+        if partial:
+            # The server gave up before checking all history; say so rather than imply there's nothing older
+            tk.Label(results, text="Search stopped early; older matches may be missing. Try more specific words.",
+                     font=('Helvetica', 9), fg='#8A6D00').pack(pady=(8, 0))
+        if not hits:
+            tk.Label(results, text=f"No messages match \"{query}\".", font=('Helvetica', 11)).pack(pady=20)
+            return
+        
+        listbox = tk.Listbox(results, font=('Helvetica', 11), activestyle='none')
+        listbox.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+        for hit in hits:
+            where = "# General" if hit['conversation'] == "General" else f"@ {hit['conversation']}"
+            listbox.insert(tk.END, f"{where}  {hit['sender']}: {hit['text']}")
+        
+        def jump(event=None):
+            selection = listbox.curselection()
+            if selection:
+                self.jump_to_message(hits[selection[0]])
+        listbox.bind('<Double-Button-1>', jump)
+        listbox.bind('<Return>', jump)
+        listbox.focus_set()
+
+    def jump_to_message(self, hit):
+        """Open the hit's conversation and scroll to and highlight the message"""
+        conv = hit['conversation']
+        history = self.conversations.get(conv, [])
+        
+        # Match by id; our own messages were displayed locally without one
+        own_text = f"You: {hit['text']}" if hit['sender'] == self.username else None
+        position = None
+        for i in range(len(history) - 1, -1, -1):
+            if history[i].get('id') == hit['id'] or (own_text and history[i]['text'] == own_text):
+                position = i
+                break
+        
+        if position is None:
+            messagebox.showinfo("Search", f"This message was sent before you joined:\n\n{hit['sender']}: {hit['text']}")
+            return
+        
+        self.switch_conversation(conv)
+        # Entries may span several lines, so count them up to the hit
+        line = 1 + sum(entry['text'].count("\n") + 1 for entry in history[:position])
+        self.chat_area.tag_remove('search_hit', 1.0, tk.END)
+        self.chat_area.tag_add('search_hit', f"{line}.0", f"{line}.end")
+        self.chat_area.tag_config('search_hit', background='#FFF3B0')
+        self.chat_area.see(f"{line}.0")
+
     def _insert_message(self, message, tag=None):
         """Insert message into chat area"""
         self.chat_area.config(state='normal')
@@ -635,7 +833,10 @@ class ChatClient:
         self.root.after(0, lambda: self._update_user_list_impl(user_str))
 
     def _update_user_list_impl(self, user_str):
-        print(f"[DEBUG] Updating user list with: {user_str}")
+        if not self.sidebar_ready:
+            self.pending_users = user_str
+            return
+        utils.debug(f"Updating user list with: {user_str}")
         users = user_str.split(",")
         self.user_listbox.delete(0, tk.END)
         for user in users:
@@ -644,15 +845,23 @@ class ChatClient:
 
     def on_close(self):
         self.running = False
-        if self.sock:
-            self.sock.close()
+        if self.conn:
+            self.conn.close()
         self.root.destroy()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Chat client")
+    parser.add_argument("--tls", action="store_true", help="Connect over TLS")
+    parser.add_argument("--cafile", help="CA or self-signed server certificate to trust")
+    parser.add_argument("--login", action="store_true", help="Ask for server and username even if remembered")
+    args = parser.parse_args()
+
     try:
-        ChatClient()
+        tls_context = utils.make_client_context(args.cafile) if args.tls or args.cafile else None
+        ChatClient(tls_context, ask_login=args.login)
     except Exception as e:
         import traceback
         with open("client_error.log", "w") as f:
+            f.write(f"Python Version: {sys.version}\nTkinter Version: {tk.TkVersion}\n\n")
             f.write(traceback.format_exc())
         messagebox.showerror("Critical Error", f"Application crashed: {e}\nSee client_error.log")
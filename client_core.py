@@ -0,0 +1,697 @@
+"""GUI-free chat client: a blocking ChatConnection and an asyncio AsyncChatConnection.
+
+Both speak the same framed protocol as server.py and turn incoming frames
+into Event tuples:
+
+    kind      sender     text             other fields
+    message   None       "alice: hi"      id (None for server notices)
+    private   "alice"    "hi"             id
+    file      "alice"    "report.pdf"     path (None if discarded), size, digest (sha256, if saved)
+    blob      "alice"    "report.pdf"     size, digest, conversation ("General" or "" for direct)
+    shared    None       "report.pdf"     digest, count (recipients), size (bytes uploaded, 0 if cached)
+    users     None       "alice,bob"      -
+    error     None       "User x not found."  digest if a share_file() failed
+    search    None       the query        hits: dicts with id, conversation, sender, text, time;
+                                          partial (True if older matches may be missing)
+"""
+import asyncio
+import hashlib
+import io
+import json
+import os
+import queue
+import tempfile
+import threading
+from collections import namedtuple
+import delta
+import utils
+
+Event = namedtuple("Event", "kind sender text path size id hits digest count conversation basis partial",
+                   defaults=(None,) * 11)
+
+PRIVATE_PREFIX = "[Private from "
+BASIS_DIR = ".basis"  # Per sender: what we last received under each filename, for deltas
+DELTA_SPOOL_SIZE = 1024 * 1024  # Incoming deltas up to this size are buffered in memory
+
+def split_id(content):
+    """Split the message id the server appends to indexed messages ("text<SEP>id")."""
+    text, sep, tail = content.rpartition(utils.SEPARATOR)
+    if sep and tail.isdigit():
+        return text, int(tail)
+    return content, None
+
+def parse_event(message):
+    """Turn a decoded frame into an Event. FILE frames return kind 'file' without a path yet."""
+    header, _, content = message.partition(utils.SEPARATOR)
+    if header == utils.HEADER_MSG:
+        text, msg_id = split_id(content)
+        return Event("message", text=text, id=msg_id)
+    if header == utils.HEADER_PVT:
+        content, msg_id = split_id(content)
+        # "[Private from Sender]: Message"
+        if content.startswith(PRIVATE_PREFIX) and "]:" in content:
+            sender_end = content.index("]:")
+            return Event("private", content[len(PRIVATE_PREFIX):sender_end], content[sender_end + 2:].strip(), id=msg_id)
+        return Event("private", text=content, id=msg_id)
+    if header == utils.HEADER_SEARCH:
+        result = json.loads(content)
+        return Event("search", text=result["query"], hits=result["hits"], partial=result.get("partial", False))
+    if header == utils.HEADER_FILE:
+        sender, filename, filesize = content.split(utils.SEPARATOR)
+        return Event("file", sender, filename, size=int(filesize))
+    if header == utils.HEADER_BLOB:
+        digest, size, filename, sender, conversation = content.split(utils.SEPARATOR)
+        return Event("blob", sender, filename, size=int(size), digest=digest, conversation=conversation)
+    if header == utils.HEADER_BLOBDATA:
+        digest, size = content.split(utils.SEPARATOR)
+        return Event("blobdata", size=int(size), digest=digest)
+    if header == utils.HEADER_SHARED:
+        digest, count, uploaded = content.split(utils.SEPARATOR)
+        return Event("shared", digest=digest, count=int(count), size=int(uploaded))
+    if header == utils.HEADER_OFFER:
+        # OFFER<SEP>Digest<SEP>PROVE<SEP>Nonce, OFFER<SEP>Digest<SEP>NEED, or OFFER<SEP>Digest<SEP>FAIL<SEP>Reason
+        digest, status, *reason = content.split(utils.SEPARATOR, 2)
+        if status == "PROVE":
+            return Event("prove", text=reason[0], digest=digest)
+        if status == "NEED":
+            return Event("need", digest=digest)
+        return Event("error", text=reason[0] if reason else "Sharing failed.", digest=digest)
+    if header == utils.HEADER_SIGREQ:
+        sender, filename = content.split(utils.SEPARATOR)
+        return Event("sigreq", sender, filename)
+    if header == utils.HEADER_SIGNATURE:
+        sender, filename, basis, size = content.split(utils.SEPARATOR)
+        return Event("signature", sender, filename, size=int(size), basis=basis)
+    if header == utils.HEADER_DELTA:
+        # Followed by delta_size bytes that rebuild a filesize-byte file from the basis
+        sender, filename, basis, digest, filesize, delta_size = content.split(utils.SEPARATOR)
+        return Event("delta", sender, filename, size=int(filesize), digest=digest, count=int(delta_size), basis=basis)
+    if header == utils.HEADER_LIST:
+        return Event("users", text=content)
+    if header == utils.HEADER_ERR:
+        return Event("error", text=content)
+    return Event("message", text=message)
+
+def file_header(target, filename, filesize):
+    return f"{utils.HEADER_FILE}{utils.SEPARATOR}{target}{utils.SEPARATOR}{filename}{utils.SEPARATOR}{filesize}"
+
+def file_digest(path):
+    """sha256 hex of a file, read in chunks so large files don't need to fit in memory."""
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(utils.RELAY_BUFFER_SIZE), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+def offer_message(digest, path, targets):
+    if isinstance(targets, str):
+        targets = [targets]
+    return utils.SEPARATOR.join([digest, os.path.basename(path), ",".join(targets)])
+
+def delta_header(target, filename, basis, digest, filesize, delta_size):
+    return utils.SEPARATOR.join([utils.HEADER_DELTA, target, filename, basis, digest, str(filesize), str(delta_size)])
+
+def compute_delta(path, sig, out):
+    """Write a delta for path against sig to out; returns its sha256, or None if not worth it."""
+    filesize = os.path.getsize(path)
+    try:
+        # Past half the file in new bytes, the CPU spent rolling isn't buying much
+        delta.delta(path, sig, out, max_literal=filesize // 2)
+    except delta.DeltaTooLarge:
+        return None
+    return file_digest(path)
+
+def basis_path(files_dir, sender, filename):
+    return os.path.join(files_dir, sender, BASIS_DIR, os.path.basename(filename) + ".json")
+
+def remember_file(files_dir, sender, filename, save_path, digest):
+    """Note where a received file is (with its hash, size and mtime) so its next version can arrive as a delta.
+
+    Only this metadata is written now; the signature is computed if and when
+    the sender asks for it, off the receive path.
+    """
+    stat = os.stat(save_path)
+    meta = {"path": save_path, "digest": digest, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    path = basis_path(files_dir, sender, filename)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding=utils.FORMAT) as f:
+        json.dump(meta, f)
+
+def load_basis(files_dir, sender, filename):
+    """Metadata of the last file received from sender as filename, or None.
+
+    A file that was deleted or edited since is no use as a basis, so it counts as missing.
+    """
+    try:
+        with open(basis_path(files_dir, sender, filename), encoding=utils.FORMAT) as f:
+            meta = json.load(f)
+        stat = os.stat(meta["path"])
+    except (OSError, ValueError, KeyError):
+        return None
+    if (stat.st_size, stat.st_mtime_ns) != (meta["size"], meta["mtime_ns"]):
+        return None
+    return meta
+
+def load_signature(files_dir, sender, filename):
+    """(meta, signature) of the basis for filename from sender, or (None, b"") if there is none.
+
+    Reads the whole basis, so call it off the receive path. A signature too big
+    for the server to relay counts as none; the sender then sends the whole file.
+    """
+    meta = load_basis(files_dir, sender, filename)
+    if meta is None:
+        return None, b""
+    blocks = -(-meta["size"] // delta.block_size_for(meta["size"]))
+    if delta.SIG_HEADER.size + blocks * delta.SIG_ENTRY.size > utils.SIGNATURE_MAX_SIZE:
+        return None, b""
+    try:
+        return meta, delta.signature(meta["path"])
+    except OSError:
+        return None, b""
+
+def patch_file(files_dir, event, delta_file):
+    """Rebuild the file a 'delta' event describes; returns the resulting 'file' or 'error' event."""
+    meta = load_basis(files_dir, event.sender, event.text)
+    if meta is None or meta["digest"] != event.basis:
+        return Event("error", text=f"Could not rebuild {event.text} from {event.sender}; ask them to send it again.")
+    # signature() picks the block size from the basis size, so the delta was made with this one
+    block_size = delta.block_size_for(meta["size"])
+    save_path = unique_path(files_dir, event.sender, event.text)
+    hasher = hashlib.sha256()
+    with open(meta["path"], 'rb') as basis, open(save_path, 'wb') as out:
+        def write(data):
+            hasher.update(data)
+            out.write(data)
+        try:
+            delta.patch(basis, delta_file, write, block_size)
+        except ValueError:
+            pass  # Caught by the hash check below
+    if hasher.hexdigest() != event.digest:
+        os.unlink(save_path)
+        return Event("error", text=f"{event.text} from {event.sender} was corrupted in transit.")
+    return Event("file", event.sender, event.text, save_path, event.size, digest=event.digest)
+
+def unique_path(files_dir, sender, filename):
+    """Where to save a file from sender, without overwriting earlier ones."""
+    sender_dir = os.path.join(files_dir, sender)
+    os.makedirs(sender_dir, exist_ok=True)
+    # Never let a remote name escape the sender's directory
+    save_path = os.path.join(sender_dir, os.path.basename(filename))
+    base, ext = os.path.splitext(save_path)
+    counter = 1
+    while os.path.exists(save_path):
+        save_path = f"{base}_{counter}{ext}"
+        counter += 1
+    return save_path
+
+def blob_received(sender, filename, save_path, event, hasher):
+    """The 'file' event for a fetched blob, or an 'error' event if it arrived corrupted."""
+    if hasher.hexdigest() != event.digest:
+        if save_path:
+            os.unlink(save_path)
+        return Event("error", text=f"{filename} from {sender} was corrupted in transit.")
+    return Event("file", sender, filename, save_path, event.size, digest=event.digest)
+
+def offer_shared(offers, event):
+    """Fill in a 'shared' event from the offer it answers; size becomes bytes uploaded."""
+    path, _ = offers.pop(event.digest, (None, None))
+    uploaded = os.path.getsize(path) if event.size and path else 0
+    return event._replace(text=os.path.basename(path) if path else None, path=path, size=uploaded)
+
+
+class ChatConnection:
+    """Blocking client. Sending is thread-safe, so one thread can read events while others send.
+
+    Incoming files are saved under files_dir/<sender>/ (or discarded if files_dir is None),
+    along with a note of each one that lets senders deliver its next version as a delta.
+    """
+
+    def __init__(self, host, port, username, tls_context=None, files_dir=None):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.tls_context = tls_context
+        self.files_dir = files_dir
+        self.sock = None
+        self.reader = None
+        self.send_lock = threading.Lock()
+        self.session_saved = False
+        self.offers = {}  # digest -> (path, progress) of files we've offered to share
+        self.notices = {}  # digest -> (sender, filename) of blobs shared with us
+        self.signature_waiters = {}  # (target, filename) -> Queue for the SIGNATURE a send_file awaits
+
+    def connect(self):
+        self.sock = utils.open_connection(self.host, self.port, self.tls_context)
+        self.reader = utils.make_reader(self.sock)
+        utils.send_frame(self.sock, self.username.encode(utils.FORMAT))
+        return self
+
+    def _send(self, header, content):
+        payload = f"{header}{utils.SEPARATOR}{content}".encode(utils.FORMAT)
+        with self.send_lock:
+            utils.send_frame(self.sock, payload)
+
+    def send(self, text):
+        """Send a message to the General room."""
+        self._send(utils.HEADER_MSG, text)
+
+    def send_private(self, target, text):
+        self._send(utils.HEADER_PVT, f"{target}{utils.SEPARATOR}{text}")
+
+    def search(self, query, conversation=""):
+        """Ask for messages matching query; the answer arrives as a 'search' event.
+
+        conversation is "General", a username for that DM, or "" for everything visible.
+        """
+        self._send(utils.HEADER_SEARCH, f"{conversation}{utils.SEPARATOR}{query}")
+
+    def send_file(self, target, path, progress=None, delta=False):
+        """Send a file to target. progress(sent, total) is called after each chunk.
+
+        With delta=True the target is first asked for the signature of the last
+        version of this file it got from us, and if it has one only the changes
+        are sent. The answer arrives as an event, so another thread must be
+        reading them. Returns the number of bytes sent.
+        """
+        filesize = os.path.getsize(path)
+        if delta and filesize >= utils.DELTA_MIN_SIZE:
+            sent = self._send_delta(target, path, progress)
+            if sent is not None:
+                return sent
+        header = file_header(target, os.path.basename(path), filesize)
+        return self._send_with_file(header, path, filesize, progress)
+
+    def _send_delta(self, target, path, progress):
+        filename = os.path.basename(path)
+        key = (target, filename)
+        waiter = self.signature_waiters[key] = queue.Queue(1)
+        try:
+            self._send(utils.HEADER_SIGREQ, f"{target}{utils.SEPARATOR}{filename}")
+            basis, sig = waiter.get(timeout=utils.SIGNATURE_TIMEOUT)
+        except queue.Empty:
+            return None
+        finally:
+            self.signature_waiters.pop(key, None)
+        if not sig:
+            return None
+        with tempfile.TemporaryFile() as out:
+            digest = compute_delta(path, sig, out)
+            if digest is None:
+                return None
+            delta_size = out.tell()
+            out.seek(0)
+            header = delta_header(target, filename, basis, digest, os.path.getsize(path), delta_size)
+            return self._send_stream(header, out, delta_size, progress)
+
+    def _answer_signature(self, sender, filename):
+        meta, sig = load_signature(self.files_dir, sender, filename) if self.files_dir else (None, b"")
+        basis = meta["digest"] if meta else ""
+        header = utils.SEPARATOR.join([utils.HEADER_SIGNATURE, sender, filename, basis, str(len(sig))])
+        self._send_stream(header, io.BytesIO(sig), len(sig), None)
+
+    def share_file(self, targets, path, progress=None):
+        """Share a file via the server's blob store with a user, a list of users, or "General".
+
+        Only the hash is sent at first. If the server already has the file, a
+        proof computed from a small part of it stands in for the upload;
+        otherwise the file is uploaded (once). A 'shared' event reports the
+        outcome. Returns the file's digest.
+        """
+        digest = file_digest(path)
+        self.offers[digest] = (path, progress)
+        self._send(utils.HEADER_OFFER, offer_message(digest, path, targets))
+        return digest
+
+    def fetch(self, digest):
+        """Download a blob announced by a 'blob' event; it arrives as a 'file' event."""
+        self._send(utils.HEADER_FETCH, digest)
+
+    def _prove(self, digest, nonce):
+        path, _ = self.offers[digest]
+        try:
+            proof = utils.possession_proof(path, nonce)
+        except OSError as e:
+            self.offers.pop(digest, None)
+            utils.debug(f"Could not read {path} to share it: {e}")
+            return
+        self._send(utils.HEADER_PROOF, f"{digest}{utils.SEPARATOR}{proof}")
+
+    def _upload(self, digest):
+        path, progress = self.offers[digest]
+        filesize = os.path.getsize(path)
+        header = f"{utils.HEADER_UPLOAD}{utils.SEPARATOR}{digest}{utils.SEPARATOR}{filesize}"
+        try:
+            self._send_with_file(header, path, filesize, progress)
+        except OSError as e:
+            self.offers.pop(digest, None)
+            utils.debug(f"Upload of {path} failed: {e}")
+
+    def _send_with_file(self, header, path, filesize, progress):
+        with open(path, 'rb') as f:
+            return self._send_stream(header, f, filesize, progress)
+
+    def _send_stream(self, header, f, filesize, progress):
+        with self.send_lock:
+            utils.send_frame(self.sock, header.encode(utils.FORMAT))
+            total_sent = 0
+            while total_sent < filesize:
+                chunk = f.read(min(utils.RELAY_BUFFER_SIZE, filesize - total_sent))
+                if not chunk:
+                    raise IOError("File shrank while it was being sent")
+                self.sock.sendall(chunk)
+                total_sent += len(chunk)
+                if progress:
+                    progress(total_sent, filesize)
+        return filesize
+
+    def recv_event(self):
+        """Block until the next event. Returns None once the server closes the connection."""
+        # Control frames (signatures, upload requests) are handled here and skipped
+        while True:
+            message = utils.recv_msg(self.reader)
+            if message is None:
+                return None
+            if self.tls_context and not self.session_saved:
+                # The TLS 1.3 ticket has arrived by now; keep it for fast reconnects
+                utils.save_tls_session(self.sock, self.host, self.port)
+                self.session_saved = True
+
+            event = parse_event(message)
+            if event.kind == "file":
+                hasher = hashlib.sha256()
+                save_path = self._receive_file(event.sender, event.text, event.size, hasher)
+                event = event._replace(path=save_path, digest=hasher.hexdigest() if save_path else None)
+            elif event.kind == "sigreq":
+                threading.Thread(target=self._answer_signature, args=(event.sender, event.text), daemon=True).start()
+                continue
+            elif event.kind == "signature":
+                waiter = self.signature_waiters.get((event.sender, event.text))
+                if waiter is None or event.size > utils.SIGNATURE_MAX_SIZE:
+                    # Unasked for or implausibly large: skip it without buffering it
+                    self._read_into(event.size, lambda data: None)
+                    continue
+                waiter.put((event.basis, self.reader.read(event.size)))
+                continue
+            elif event.kind == "delta":
+                with tempfile.SpooledTemporaryFile(max_size=DELTA_SPOOL_SIZE) as delta_file:
+                    self._read_into(event.count, delta_file.write)
+                    delta_file.seek(0)
+                    if self.files_dir:
+                        event = patch_file(self.files_dir, event, delta_file)
+                    else:
+                        event = Event("file", event.sender, event.text, size=event.size)
+            elif event.kind == "prove":
+                threading.Thread(target=self._prove, args=(event.digest, event.text), daemon=True).start()
+                continue
+            elif event.kind == "need":
+                # The server lacks this blob; upload it without holding up the reader
+                threading.Thread(target=self._upload, args=(event.digest,), daemon=True).start()
+                continue
+            elif event.kind == "blob":
+                self.notices[event.digest] = (event.sender, event.text)
+            elif event.kind == "blobdata":
+                sender, filename = self.notices.pop(event.digest, ("server", event.digest[:12]))
+                hasher = hashlib.sha256()
+                save_path = self._receive_file(sender, filename, event.size, hasher)
+                event = blob_received(sender, filename, save_path, event, hasher)
+            elif event.kind == "shared":
+                event = offer_shared(self.offers, event)
+            elif event.kind == "error" and event.digest:
+                self.offers.pop(event.digest, None)
+            if event.kind == "file" and event.path:
+                remember_file(self.files_dir, event.sender, event.text, event.path, event.digest)
+            return event
+
+    def _receive_file(self, sender, filename, filesize, hasher):
+        save_path = unique_path(self.files_dir, sender, filename) if self.files_dir else None
+        if save_path is None:
+            self._read_into(filesize, hasher.update)
+            return None
+        with open(save_path, 'wb') as out:
+            def write(data):
+                out.write(data)
+                hasher.update(data)
+            self._read_into(filesize, write)
+        return save_path
+
+    def _read_into(self, size, write):
+        remaining = size
+        while remaining > 0:
+            data = self.reader.read1(min(remaining, utils.RELAY_BUFFER_SIZE))
+            if not data:
+                raise ConnectionError("Connection closed during file transfer")
+            write(data)
+            remaining -= len(data)
+
+    def __iter__(self):
+        while True:
+            event = self.recv_event()
+            if event is None:
+                return
+            yield event
+
+    def close(self):
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+    def __enter__(self):
+        return self.connect()
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class AsyncChatConnection:
+    """asyncio client with the same API as ChatConnection; iterate with `async for`."""
+
+    def __init__(self, host, port, username, tls_context=None, files_dir=None):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.tls_context = tls_context
+        self.files_dir = files_dir
+        self.reader = None
+        self.writer = None
+        self.send_lock = asyncio.Lock()
+        self.offers = {}
+        self.notices = {}
+        self.signature_waiters = {}  # (target, filename) -> Future for the SIGNATURE a send_file awaits
+        self.tasks = set()  # Running upload/signature tasks, referenced so they aren't garbage collected
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(
+            self.host, self.port, ssl=self.tls_context, limit=utils.RELAY_BUFFER_SIZE
+        )
+        self._write_frame(self.username.encode(utils.FORMAT))
+        await self.writer.drain()
+        return self
+
+    def _write_frame(self, payload):
+        self.writer.write(utils.FRAME_HEADER.pack(len(payload)) + payload)
+
+    async def _send(self, header, content):
+        # write() only buffers; drain() applies backpressure without a syscall per message
+        async with self.send_lock:
+            self._write_frame(f"{header}{utils.SEPARATOR}{content}".encode(utils.FORMAT))
+            await self.writer.drain()
+
+    async def send(self, text):
+        await self._send(utils.HEADER_MSG, text)
+
+    async def send_private(self, target, text):
+        await self._send(utils.HEADER_PVT, f"{target}{utils.SEPARATOR}{text}")
+
+    async def search(self, query, conversation=""):
+        await self._send(utils.HEADER_SEARCH, f"{conversation}{utils.SEPARATOR}{query}")
+
+    async def send_file(self, target, path, progress=None, delta=False):
+        filesize = os.path.getsize(path)
+        if delta and filesize >= utils.DELTA_MIN_SIZE:
+            sent = await self._send_delta(target, path, progress)
+            if sent is not None:
+                return sent
+        header = file_header(target, os.path.basename(path), filesize)
+        return await self._send_with_file(header, path, filesize, progress)
+
+    async def _send_delta(self, target, path, progress):
+        filename = os.path.basename(path)
+        key = (target, filename)
+        waiter = self.signature_waiters[key] = asyncio.get_running_loop().create_future()
+        try:
+            await self._send(utils.HEADER_SIGREQ, f"{target}{utils.SEPARATOR}{filename}")
+            basis, sig = await asyncio.wait_for(waiter, utils.SIGNATURE_TIMEOUT)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            self.signature_waiters.pop(key, None)
+        if not sig:
+            return None
+        with tempfile.TemporaryFile() as out:
+            digest = await asyncio.to_thread(compute_delta, path, sig, out)
+            if digest is None:
+                return None
+            delta_size = out.tell()
+            out.seek(0)
+            header = delta_header(target, filename, basis, digest, os.path.getsize(path), delta_size)
+            return await self._send_stream(header, out, delta_size, progress)
+
+    async def _answer_signature(self, sender, filename):
+        if self.files_dir:
+            meta, sig = await asyncio.to_thread(load_signature, self.files_dir, sender, filename)
+        else:
+            meta, sig = None, b""
+        basis = meta["digest"] if meta else ""
+        header = utils.SEPARATOR.join([utils.HEADER_SIGNATURE, sender, filename, basis, str(len(sig))])
+        await self._send_stream(header, io.BytesIO(sig), len(sig), None)
+
+    def _spawn(self, coro):
+        self.tasks.add(asyncio.create_task(coro))
+        self.tasks = {task for task in self.tasks if not task.done()}
+
+    async def share_file(self, targets, path, progress=None):
+        digest = await asyncio.to_thread(file_digest, path)
+        self.offers[digest] = (path, progress)
+        await self._send(utils.HEADER_OFFER, offer_message(digest, path, targets))
+        return digest
+
+    async def fetch(self, digest):
+        await self._send(utils.HEADER_FETCH, digest)
+
+    async def _prove(self, digest, nonce):
+        path, _ = self.offers[digest]
+        try:
+            proof = await asyncio.to_thread(utils.possession_proof, path, nonce)
+        except OSError as e:
+            self.offers.pop(digest, None)
+            utils.debug(f"Could not read {path} to share it: {e}")
+            return
+        await self._send(utils.HEADER_PROOF, f"{digest}{utils.SEPARATOR}{proof}")
+
+    async def _upload(self, digest):
+        path, progress = self.offers[digest]
+        filesize = os.path.getsize(path)
+        header = f"{utils.HEADER_UPLOAD}{utils.SEPARATOR}{digest}{utils.SEPARATOR}{filesize}"
+        try:
+            await self._send_with_file(header, path, filesize, progress)
+        except OSError as e:
+            self.offers.pop(digest, None)
+            utils.debug(f"Upload of {path} failed: {e}")
+
+    async def _send_with_file(self, header, path, filesize, progress):
+        with open(path, 'rb') as f:
+            return await self._send_stream(header, f, filesize, progress)
+
+    async def _send_stream(self, header, f, filesize, progress):
+        async with self.send_lock:
+            self._write_frame(header.encode(utils.FORMAT))
+            total_sent = 0
+            while total_sent < filesize:
+                chunk = f.read(min(utils.RELAY_BUFFER_SIZE, filesize - total_sent))
+                if not chunk:
+                    raise IOError("File shrank while it was being sent")
+                self.writer.write(chunk)
+                await self.writer.drain()
+                total_sent += len(chunk)
+                if progress:
+                    progress(total_sent, filesize)
+        return filesize
+
+    async def recv_event(self):
+        # Control frames (signatures, upload requests) are handled here and skipped
+        while True:
+            try:
+                prefix = await self.reader.readexactly(utils.FRAME_HEADER.size)
+                (length,) = utils.FRAME_HEADER.unpack(prefix)
+                payload = await self.reader.readexactly(length)
+            except asyncio.IncompleteReadError:
+                return None
+
+            event = parse_event(payload.decode(utils.FORMAT))
+            if event.kind == "file":
+                hasher = hashlib.sha256()
+                save_path = await self._receive_file(event.sender, event.text, event.size, hasher)
+                event = event._replace(path=save_path, digest=hasher.hexdigest() if save_path else None)
+            elif event.kind == "sigreq":
+                self._spawn(self._answer_signature(event.sender, event.text))
+                continue
+            elif event.kind == "signature":
+                waiter = self.signature_waiters.get((event.sender, event.text))
+                if waiter is None or waiter.done() or event.size > utils.SIGNATURE_MAX_SIZE:
+                    await self._read_into(event.size, lambda data: None)
+                    continue
+                waiter.set_result((event.basis, await self.reader.readexactly(event.size)))
+                continue
+            elif event.kind == "delta":
+                with tempfile.SpooledTemporaryFile(max_size=DELTA_SPOOL_SIZE) as delta_file:
+                    await self._read_into(event.count, delta_file.write)
+                    delta_file.seek(0)
+                    if self.files_dir:
+                        event = await asyncio.to_thread(patch_file, self.files_dir, event, delta_file)
+                    else:
+                        event = Event("file", event.sender, event.text, size=event.size)
+            elif event.kind == "prove":
+                self._spawn(self._prove(event.digest, event.text))
+                continue
+            elif event.kind == "need":
+                self._spawn(self._upload(event.digest))
+                continue
+            elif event.kind == "blob":
+                self.notices[event.digest] = (event.sender, event.text)
+            elif event.kind == "blobdata":
+                sender, filename = self.notices.pop(event.digest, ("server", event.digest[:12]))
+                hasher = hashlib.sha256()
+                save_path = await self._receive_file(sender, filename, event.size, hasher)
+                event = blob_received(sender, filename, save_path, event, hasher)
+            elif event.kind == "shared":
+                event = offer_shared(self.offers, event)
+            elif event.kind == "error" and event.digest:
+                self.offers.pop(event.digest, None)
+            if event.kind == "file" and event.path:
+                await asyncio.to_thread(remember_file, self.files_dir, event.sender, event.text, event.path, event.digest)
+            return event
+
+    async def _receive_file(self, sender, filename, filesize, hasher):
+        save_path = unique_path(self.files_dir, sender, filename) if self.files_dir else None
+        if save_path is None:
+            await self._read_into(filesize, hasher.update)
+            return None
+        with open(save_path, 'wb') as out:
+            def write(data):
+                out.write(data)
+                hasher.update(data)
+            await self._read_into(filesize, write)
+        return save_path
+
+    async def _read_into(self, size, write):
+        remaining = size
+        while remaining > 0:
+            data = await self.reader.read(min(remaining, utils.RELAY_BUFFER_SIZE))
+            if not data:
+                raise ConnectionError("Connection closed during file transfer")
+            write(data)
+            remaining -= len(data)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        event = await self.recv_event()
+        if event is None:
+            raise StopAsyncIteration
+        return event
+
+    async def close(self):
+        if self.writer:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+            self.writer = None
+
+    async def __aenter__(self):
+        return await self.connect()
+
+    async def __aexit__(self, *exc):
+        await self.close()
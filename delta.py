@@ -0,0 +1,173 @@
+"""rsync-style delta encoding between two versions of a file.
+
+The receiver describes the version it already has with a signature: a weak
+rolling checksum (Adler-32) and a strong hash per fixed-size block. The
+sender slides a window over the new version looking for blocks with a
+matching signature and emits a delta of COPY ops (reuse blocks the receiver
+has) and LITERAL ops (new bytes). patch() rebuilds the new version from the
+old one and the delta.
+
+    signature:  SIG_HEADER (block size, basis size), then SIG_ENTRY per block
+    delta:      a sequence of COPY (first block, block count) and LITERAL (length) + bytes
+"""
+import hashlib
+import math
+import mmap
+import struct
+import zlib
+
+BLOCK_MIN = 2 * 1024
+BLOCK_MAX = 64 * 1024
+ADLER_MOD = 65521
+
+SIG_HEADER = struct.Struct("!IQ")  # block size, basis size
+SIG_ENTRY = struct.Struct("!I16s")  # weak checksum, strong hash
+OP_COPY = struct.Struct("!cII")  # b"C", first block, block count
+OP_LITERAL = struct.Struct("!cI")  # b"L", length; followed by the bytes
+
+def block_size_for(size):
+    """About sqrt(size), like rsync: signature and per-edit cost both stay small."""
+    return max(BLOCK_MIN, min(BLOCK_MAX, 1 << math.isqrt(size).bit_length()))
+
+def strong_hash(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+def signature(path, block_size=None):
+    """Signature of the file at path, as bytes."""
+    with open(path, 'rb') as f:
+        size = f.seek(0, 2)
+        f.seek(0)
+        block_size = block_size or block_size_for(size)
+        parts = [SIG_HEADER.pack(block_size, size)]
+        for block in iter(lambda: f.read(block_size), b""):
+            parts.append(SIG_ENTRY.pack(zlib.adler32(block), strong_hash(block)))
+    return b"".join(parts)
+
+def parse_signature(data):
+    """Returns (block_size, {weak checksum: {strong hash: block index}})."""
+    block_size, _ = SIG_HEADER.unpack_from(data)
+    blocks = {}
+    for index, (weak, strong) in enumerate(SIG_ENTRY.iter_unpack(memoryview(data)[SIG_HEADER.size:])):
+        blocks.setdefault(weak, {}).setdefault(strong, index)
+    return block_size, blocks
+
+
+class DeltaTooLarge(Exception):
+    """The delta would exceed its literal budget; sending the whole file is about as cheap."""
+
+
+class _DeltaWriter:
+    """Buffers ops so runs of consecutive blocks collapse into one COPY."""
+
+    def __init__(self, out):
+        self.out = out
+        self.copy_start = None
+        self.copy_count = 0
+        self.literal_bytes = 0
+
+    def copy(self, index):
+        if self.copy_start is not None and index == self.copy_start + self.copy_count:
+            self.copy_count += 1
+            return
+        self.flush()
+        self.copy_start, self.copy_count = index, 1
+
+    def literal(self, data):
+        self.flush()
+        self.out.write(OP_LITERAL.pack(b"L", len(data)))
+        self.out.write(data)
+        self.literal_bytes += len(data)
+
+    def flush(self):
+        if self.copy_start is not None:
+            self.out.write(OP_COPY.pack(b"C", self.copy_start, self.copy_count))
+            self.copy_start = None
+
+
+def delta(path, sig, out, max_literal=None):
+    """Write the delta turning the signed basis into the file at path to out.
+
+    Matching blocks are checked with the C Adler-32 first, so unchanged runs
+    cost about as much as hashing them; the Python rolling loop only runs
+    through edited regions. Raises DeltaTooLarge once more than max_literal
+    new bytes are needed. Returns the number of literal bytes.
+    """
+    block_size, blocks = parse_signature(sig)
+    lookup = blocks.get
+    writer = _DeltaWriter(out)
+    with open(path, 'rb') as f:
+        size = f.seek(0, 2)
+        if size == 0:
+            return 0
+        if max_literal is None:
+            max_literal = size
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            literal_start = 0  # Start of bytes not yet covered by an op
+            pos = 0
+            while pos < size:
+                end = min(pos + block_size, size)
+                window = end - pos
+                weak = zlib.adler32(data[pos:end])
+                a, b = weak & 0xFFFF, weak >> 16
+                give_up = literal_start + max_literal - writer.literal_bytes
+                # Roll one byte at a time until a block matches or the data runs out
+                while True:
+                    candidates = lookup((b << 16) | a)
+                    if candidates:
+                        index = candidates.get(strong_hash(data[pos:pos + window]))
+                        if index is not None:
+                            break
+                    if end >= size:
+                        index = None
+                        break
+                    if pos > give_up:
+                        raise DeltaTooLarge(path)
+                    out_byte = data[pos]
+                    a = (a - out_byte + data[end]) % ADLER_MOD
+                    b = (b - window * out_byte + a - 1) % ADLER_MOD
+                    pos += 1
+                    end += 1
+                if index is None:
+                    break
+                if pos > literal_start:
+                    writer.literal(data[literal_start:pos])
+                writer.copy(index)
+                pos += window
+                literal_start = pos
+            if literal_start < size:
+                if size - literal_start > max_literal - writer.literal_bytes:
+                    raise DeltaTooLarge(path)
+                writer.literal(data[literal_start:size])
+    writer.flush()
+    return writer.literal_bytes
+
+def patch(basis, delta_file, write, block_size):
+    """Rebuild the new version from the basis and delta file objects, passing it to write()."""
+    while True:
+        op = delta_file.read(1)
+        if not op:
+            return
+        if op == b"C":
+            first, count = struct.unpack("!II", _read_exact(delta_file, OP_COPY.size - 1))
+            basis.seek(first * block_size)
+            remaining = count * block_size
+            while remaining > 0:
+                chunk = basis.read(min(remaining, BLOCK_MAX))
+                if not chunk:
+                    break  # The last block is short
+                write(chunk)
+                remaining -= len(chunk)
+        elif op == b"L":
+            (length,) = struct.unpack("!I", _read_exact(delta_file, OP_LITERAL.size - 1))
+            while length > 0:
+                chunk = _read_exact(delta_file, min(length, BLOCK_MAX))
+                write(chunk)
+                length -= len(chunk)
+        else:
+            raise ValueError(f"Corrupt delta: unknown op {op!r}")
+
+def _read_exact(f, size):
+    data = f.read(size)
+    if len(data) != size:
+        raise ValueError("Corrupt delta: truncated")
+    return data
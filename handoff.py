@@ -0,0 +1,55 @@
+import json
+import os
+import socket
+import utils
+
+# Linux refuses more than 253 descriptors in one SCM_RIGHTS message
+MAX_FDS_PER_MESSAGE = 200
+
+def send_state(conn, state, fds):
+    """Send the JSON state followed by the descriptors, in batches, over a Unix socket."""
+    utils.send_frame(conn, json.dumps(state).encode(utils.FORMAT))
+    for start in range(0, len(fds), MAX_FDS_PER_MESSAGE):
+        batch = fds[start:start + MAX_FDS_PER_MESSAGE]
+        socket.send_fds(conn, [utils.FRAME_HEADER.pack(len(batch))], batch)
+
+def recv_state(conn, fd_count):
+    """Receive what send_state sent. fd_count comes from the state itself."""
+    fds = []
+    while len(fds) < fd_count:
+        marker, batch, _, _ = socket.recv_fds(conn, utils.FRAME_HEADER.size, MAX_FDS_PER_MESSAGE)
+        if not marker:
+            raise ConnectionError("Handoff connection closed early")
+        fds.extend(batch)
+    return fds
+
+def _recv_exact(conn, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Handoff refused by running server")
+        data += chunk
+    return bytes(data)
+
+def request_takeover(path):
+    """Ask the server listening on path to hand over. Returns (state, fds, conn).
+
+    The caller must send b"OK" on conn once it has adopted the descriptors.
+    """
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.connect(path)
+    # Read exactly one frame: a read-ahead would swallow (and close) the descriptors behind it
+    (length,) = utils.FRAME_HEADER.unpack(_recv_exact(conn, utils.FRAME_HEADER.size))
+    state = json.loads(_recv_exact(conn, length).decode(utils.FORMAT))
+    fds = recv_state(conn, 1 + len(state["clients"]))
+    return state, fds, conn
+
+def listen(path):
+    """Bind the Unix control socket, replacing a stale socket file."""
+    if os.path.exists(path):
+        os.unlink(path)
+    control = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    control.bind(path)
+    control.listen(1)
+    return control
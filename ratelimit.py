@@ -0,0 +1,97 @@
+import threading
+import time
+
+# Seconds of traffic a bucket may absorb in one burst
+BURST_SECONDS = 2
+
+class TokenBucket:
+    """Token bucket refilled lazily from the clock, so checks are O(1) and need no timer thread."""
+
+    def __init__(self, rate, capacity=None, now=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate * BURST_SECONDS
+        self.tokens = self.capacity
+        self.updated = time.monotonic() if now is None else now
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def consume(self, amount, now):
+        """Take amount tokens if available. Returns False (taking nothing) otherwise."""
+        self._refill(now)
+        if self.tokens < amount:
+            return False
+        self.tokens -= amount
+        return True
+
+    def reserve(self, amount, now):
+        """Take amount tokens, going into debt if needed. Returns seconds to wait before proceeding."""
+        self._refill(now)
+        self.tokens -= amount
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def is_full(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class RateLimiter:
+    """Per-user and per-IP limits for messages, message bytes and file bandwidth.
+
+    Each limit is a (user_rate, ip_rate) pair in units per second; a rate of 0
+    disables that bucket. Buckets are created on first use.
+    """
+
+    KINDS = ("msg", "bytes", "file")
+
+    def __init__(self, msg=(0, 0), bytes=(0, 0), file=(0, 0)):
+        self.rates = {"msg": msg, "bytes": bytes, "file": file}
+        self.buckets = {}  # Map (kind, scope, key) -> TokenBucket
+        self.lock = threading.Lock()
+
+    def _buckets_for(self, kind, username, ip, now):
+        user_rate, ip_rate = self.rates[kind]
+        buckets = []
+        for scope, key, rate in (("user", username, user_rate), ("ip", ip, ip_rate)):
+            if rate:
+                bucket = self.buckets.get((kind, scope, key))
+                if bucket is None:
+                    bucket = self.buckets[(kind, scope, key)] = TokenBucket(rate, now=now)
+                buckets.append(bucket)
+        return buckets
+
+    def allow_message(self, username, ip, size):
+        """Check one incoming message of size bytes against the msg and bytes buckets."""
+        now = time.monotonic()
+        with self.lock:
+            checks = [(b, 1) for b in self._buckets_for("msg", username, ip, now)]
+            checks += [(b, size) for b in self._buckets_for("bytes", username, ip, now)]
+            # All-or-nothing: a message rejected by one bucket must not drain the others
+            for bucket, _ in checks:
+                bucket._refill(now)
+            if any(bucket.tokens < amount for bucket, amount in checks):
+                return False
+            for bucket, amount in checks:
+                bucket.tokens -= amount
+            return True
+
+    def limits(self, kind):
+        """True if any bucket of this kind is enabled."""
+        return any(self.rates[kind])
+
+    def file_delay(self, username, ip, size):
+        """Charge size bytes of file data. Returns how long the relay should pause."""
+        now = time.monotonic()
+        with self.lock:
+            return max([b.reserve(size, now) for b in self._buckets_for("file", username, ip, now)] or [0.0])
+
+    def release(self, username, ip):
+        """Forget a disconnected user's buckets, and IP buckets that have fully refilled."""
+        now = time.monotonic()
+        with self.lock:
+            for kind in self.KINDS:
+                self.buckets.pop((kind, "user", username), None)
+                bucket = self.buckets.get((kind, "ip", ip))
+                if bucket is not None and bucket.is_full(now):
+                    del self.buckets[(kind, "ip", ip)]
@@ -0,0 +1,196 @@
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from array import array
+from bisect import bisect_right
+from heapq import merge
+from itertools import islice
+
+TOKEN_RE = re.compile(r"\w+")
+GENERAL = "General"
+MAX_PROBES = 20000  # Posting lookups one query may make before it settles for the hits found so far (partial)
+REPLAY_CHUNK = 1024 * 1024  # Bytes of message log read at a time when rebuilding the index
+
+def tokenize(text):
+    """Lower-cased word tokens, each counted once per message."""
+    return set(TOKEN_RE.findall(text.lower()))
+
+def private_conversation(user_a, user_b):
+    """Index key for the DM between two users, the same whichever of them sent."""
+    return tuple(sorted((user_a, user_b)))
+
+def _intersect_newest(lists, limit, budget):
+    """Newest ids present in every (postings, length) list, the probes spent, and whether it ran out.
+
+    Leapfrogs from the newest end: each list skips straight to the newest id
+    not above the current candidate, so runs where the terms don't co-occur
+    are jumped over rather than walked. Stops early once budget probes are
+    used, reporting True if older ids were left unchecked.
+    """
+    lists = sorted(lists, key=lambda entry: entry[1])
+    (rarest, i), others = lists[0], lists[1:]
+    bounds = [length for _, length in others]
+    hits = []
+    probes = 0
+    i -= 1
+    while i >= 0 and probes < budget:
+        candidate = rarest[i]
+        for j, (postings, _) in enumerate(others):
+            k = bisect_right(postings, candidate, 0, bounds[j]) - 1
+            probes += 1
+            if k < 0:
+                return hits, probes, False
+            bounds[j] = k + 1
+            if postings[k] != candidate:
+                # Skip the rarest list back to the newest id that could still match
+                i = bisect_right(rarest, postings[k], 0, i) - 1
+                probes += 1
+                break
+        else:
+            hits.append(candidate)
+            if len(hits) == limit:
+                break
+            i -= 1
+    return hits, probes, i >= 0 and len(hits) < limit
+
+
+class SearchIndex:
+    """Incremental inverted index over chat messages.
+
+    Message ids are assigned in arrival order, so every posting list is an
+    append-only, sorted array('I') (4 bytes per entry). Postings are keyed by
+    (conversation, term), which makes per-conversation filtering and access
+    control a matter of choosing which keys to look at. Hits are ranked
+    newest first, so a query intersects its posting lists backwards and
+    stops as soon as it has enough matches. Since the arrays only grow, a
+    query snapshots their lengths under the lock and scans without it, so
+    searches never hold up add().
+
+    Message text isn't kept in memory: each message is appended to a log at
+    path as a JSON line, and only its 8-byte offset stays resident. Opening
+    an existing log replays it, so history survives restarts; a hot restart
+    opens it while the old process is still writing and calls refresh()
+    once it has taken over. Without a path the log is an anonymous temp file.
+    """
+
+    def __init__(self, path=None):
+        self.log = open(path, 'a+b') if path else tempfile.TemporaryFile()
+        self.offsets = array('Q')  # msg_id -> where its line starts in the log
+        self.end = 0  # End of the last complete line read or written
+        self.sealed = False  # Whether a torn last line (from a crash) has been terminated
+        self.postings = {}  # (conversation, term) -> array('I') of msg_ids
+        self.user_conversations = {}  # username -> set of private conversation keys
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()  # Orders log appends; held across disk writes so self.lock isn't
+        self.refresh()
+
+    def add(self, conversation, sender, text):
+        """Index a message and return its id. It is searchable as soon as this returns."""
+        terms = tokenize(text)
+        line = (json.dumps([conversation, sender, text, time.time()]) + "\n").encode()
+        fd = self.log.fileno()
+        with self.write_lock:
+            if not self.sealed:
+                # We're the only writer now; end any line a crashed process left half-written
+                size = os.fstat(fd).st_size
+                if size > self.end:
+                    os.pwrite(fd, b"\n", size)
+                    with self.lock:
+                        self.offsets.append(self.end)
+                        self.end = size + 1
+                self.sealed = True
+            os.pwrite(fd, line, self.end)
+            with self.lock:
+                msg_id = len(self.offsets)
+                self.offsets.append(self.end)
+                self.end += len(line)
+                self._index(msg_id, conversation, terms)
+        return msg_id
+
+    def refresh(self):
+        """Index lines appended to the log since it was last read, e.g. by the process before a hot restart."""
+        fd = self.log.fileno()
+        with self.write_lock, self.lock:
+            size = os.fstat(fd).st_size
+            length = REPLAY_CHUNK
+            while self.end < size:
+                chunk = os.pread(fd, min(length, size - self.end), self.end)
+                last = chunk.rfind(b"\n")
+                if last < 0:
+                    if self.end + len(chunk) >= size:
+                        break  # A line still being written (or torn by a crash)
+                    length *= 2  # One line longer than the chunk
+                    continue
+                start = self.end
+                for line in chunk[:last].split(b"\n"):
+                    msg_id = len(self.offsets)
+                    self.offsets.append(start)
+                    start += len(line) + 1
+                    try:
+                        conversation, _, text, _ = json.loads(line)
+                    except ValueError:
+                        continue  # Torn by a crash; keeps its id so later ids don't shift
+                    if conversation != GENERAL:
+                        conversation = tuple(conversation)
+                    self._index(msg_id, conversation, tokenize(text))
+                self.end += last + 1
+
+    def _index(self, msg_id, conversation, terms):
+        for term in terms:
+            postings = self.postings.get((conversation, term))
+            if postings is None:
+                postings = self.postings[(conversation, term)] = array('I')
+            postings.append(msg_id)
+        if conversation != GENERAL:
+            for user in conversation:
+                self.user_conversations.setdefault(user, set()).add(conversation)
+
+    def conversations_for(self, username, conversation=None):
+        """Conversation keys username may search: one if conversation is given, else all of theirs."""
+        if conversation == GENERAL:
+            return [GENERAL]
+        if conversation:
+            return [private_conversation(username, conversation)]
+        return [GENERAL] + sorted(self.user_conversations.get(username, ()))
+
+    def search(self, query, conversations, limit=20):
+        """(ids, partial): the newest messages containing every query term, newest first.
+
+        Terms that are each common but rarely appear together could make a query
+        scan millions of ids; past MAX_PROBES lookups it returns what it has
+        found, with partial set since older matches may have been missed.
+        """
+        terms = tokenize(query)
+        if not terms:
+            return [], False
+        snapshots = []
+        with self.lock:
+            for conversation in conversations:
+                lists = [self.postings.get((conversation, term)) for term in terms]
+                if all(postings is not None for postings in lists):
+                    snapshots.append([(postings, len(postings)) for postings in lists])
+        per_conversation = []
+        budget = MAX_PROBES
+        partial = False
+        for lists in snapshots:
+            if budget <= 0:
+                partial = True  # Conversations left unsearched
+                break
+            hits, probes, exhausted = _intersect_newest(lists, limit, budget)
+            per_conversation.append(hits)
+            budget -= probes
+            partial = partial or exhausted
+        return list(islice(merge(*per_conversation, reverse=True), limit)), partial
+
+    def hit(self, msg_id, username):
+        """Describe a message for username, naming DMs after the other participant."""
+        with self.lock:
+            start = self.offsets[msg_id]
+            end = self.offsets[msg_id + 1] if msg_id + 1 < len(self.offsets) else self.end
+        conversation, sender, text, timestamp = json.loads(os.pread(self.log.fileno(), end - start, start))
+        if conversation != GENERAL:
+            conversation = conversation[0] if conversation[1] == username else conversation[1]
+        return {"id": msg_id, "conversation": conversation, "sender": sender, "text": text, "time": timestamp}
@@ -1,62 +1,284 @@
+import argparse
+import base64
+import collections
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import signal
 import socket
+import tempfile
 import threading
+import time
+import handoff
 import utils
+from blobstore import BlobStore, BlobStoreFull
+from ratelimit import RateLimiter
+from search import GENERAL, SearchIndex, private_conversation
+
+RELAY_SPOOL_SIZE = 8 * 1024 * 1024  # Throttled relays larger than this are spooled to disk
+RAW_PAYLOAD_HEADERS = (utils.HEADER_FILE, utils.HEADER_UPLOAD, utils.HEADER_SIGNATURE, utils.HEADER_DELTA)
 
 class ChatServer:
-    def __init__(self):
-        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server.bind((utils.HOST, utils.PORT))
-        self.server.listen()
+    def __init__(self, host=utils.HOST, port=utils.PORT, certfile=None, keyfile=None, limiter=None, listener=None,
+                 blobs=None, index=None):
+        if listener is None:
+            listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listener.bind((host, port))
+            listener.listen()
+        self.server = listener
         self.clients = {}  # Map username -> socket
         self.addresses = {} # Map socket -> address
-        print(f"Server listening on {utils.HOST}:{utils.PORT}")
+        self.send_locks = {}  # Map socket -> lock serialising writes (required for TLS sockets)
+        self.readers = {}  # Map socket -> FrameReader (its unread bytes travel with a hot restart)
+        self.threads = []  # Client handler threads, joined on shutdown
+        self.busy = set()  # Sockets whose handler is in the middle of a frame
+        self.stopping = threading.Event()  # Set to drain or hot restart; handlers park between frames
+        self.handoff_conn = None  # Unix socket to the process taking over, if any
+        self.control = None
+        self.control_path = None
+        self.limiter = limiter or RateLimiter()
+        self.metrics = collections.Counter()  # Receive-path counters (messages, limited, bytes, ...)
+        self.metrics_lock = threading.Lock()  # Handler threads all update metrics; see count()
+        self.index = index or SearchIndex()  # Message log on disk, postings in memory
+        self.blobs = blobs  # BlobStore for OFFER/FETCH file sharing; None disables it
+        self.pending_uploads = {}  # Map (username, digest) -> (filename, targets) awaiting UPLOAD
+        self.deliveries = {}  # Map username -> Counter of blob digests announced but not yet fetched
+        self.challenges = {}  # Map (username, digest) -> nonce of an OFFER awaiting its PROOF
+        self.blob_access = {}  # Map username -> digests sent to them and not yet fetched (kept across sessions)
+        self.signature_requests = set()  # (requester, target, filename) SIGREQs awaiting a SIGNATURE
+        self.tls_context = None
+        if certfile:
+            self.tls_context = utils.make_server_context(certfile, keyfile)
+        scheme = "TLS" if self.tls_context else "plaintext"
+        host, port = self.server.getsockname()[:2]
+        print(f"Server listening on {host}:{port} ({scheme})")
+
+    @classmethod
+    def takeover(cls, path, **kwargs):
+        """Create a server from the listener and clients of the one serving handoffs on path."""
+        state, fds, conn = handoff.request_takeover(path)
+        server = cls(listener=socket.socket(fileno=fds[0]), **kwargs)
+        server.metrics.update(state["metrics"])
+        if server.blobs:
+            # The old process has finished its uploads by now; pick up what it stored
+            server.blobs.rescan()
+        # Likewise the messages it logged after we opened the history
+        server.index.refresh()
+        for username, filename, digest, targets in state.get("pending_uploads", []):
+            server.pending_uploads[(username, digest)] = (filename, targets)
+        for username, digest, nonce in state.get("challenges", []):
+            server.challenges[(username, digest)] = nonce
+        for username, digests in state.get("blob_access", {}).items():
+            server.blob_access[username] = set(digests)
+        for username, pending in state.get("deliveries", {}).items():
+            server.deliveries[username] = collections.Counter(pending)
+            for digest, count in pending.items():
+                if server.blobs:
+                    server.blobs.acquire(digest, count)
+        for entry, fd in zip(state["clients"], fds[1:]):
+            client_sock = socket.socket(fileno=fd)
+            client_sock.setblocking(True)
+            reader = utils.make_reader(client_sock, base64.b64decode(entry["pending"]))
+            address = tuple(entry["address"])
+            server.register(entry["username"], client_sock, reader, address)
+            server.spawn(server.serve_client, entry["username"], client_sock, reader, address)
+        print(f"Took over {len(state['clients'])} connections from {path}")
+
+        conn.sendall(b"OK")
+        # The old process closes the connection once it has released the control path
+        while conn.recv(utils.BUFFER_SIZE):
+            pass
+        conn.close()
+        return server
+
+    def count(self, key, amount=1):
+        """Add to a metric; += on the Counter alone would lose updates between handler threads."""
+        with self.metrics_lock:
+            self.metrics[key] += amount
 
-    def broadcast(self, message, sender_name=None):
-        """Send a message to all connected clients."""
-        print(f"[DEBUG] Broadcasting: {message} (Sender: {sender_name})")
-        for name, client_sock in self.clients.items():
+    def send_to(self, client_sock, header, content):
+        """Send a message to one client without interleaving with other writers."""
+        with self.send_locks.get(client_sock, threading.Lock()):
+            utils.send_msg(client_sock, header, content)
+
+    def broadcast(self, message, sender_name=None, msg_id=None):
+        """Send a message to all connected clients. Indexed chat messages carry their id last."""
+        utils.debug(f"Broadcasting: {message} (Sender: {sender_name})")
+        if msg_id is not None:
+            message = f"{message}{utils.SEPARATOR}{msg_id}"
+        for name, client_sock in list(self.clients.items()):
             if name != sender_name:
                 try:
-                    print(f"[DEBUG] Sending to {name}")
-                    utils.send_msg(client_sock, utils.HEADER_MSG, message)
+                    utils.debug(f"Sending to {name}")
+                    self.send_to(client_sock, utils.HEADER_MSG, message)
                 except Exception as e:
                     print(f"[DEBUG] Error sending to {name}: {e}")
                     self.remove_client(name)
 
     def handle_client(self, client_sock, address):
         """Handle individual client connection."""
-        username = None
         try:
+            # Bound the login phase so a silent peer can't hold up a drain
+            client_sock.settimeout(utils.LOGIN_TIMEOUT)
+            if self.tls_context:
+                # Handshake here rather than in accept() so a slow client can't stall the listener
+                client_sock = self.tls_context.wrap_socket(client_sock, server_side=True)
+            reader = utils.make_reader(client_sock)
+
             # First message should be the username
-            username = client_sock.recv(utils.BUFFER_SIZE).decode(utils.FORMAT)
+            username = utils.recv_msg(reader)
+            if not username:
+                client_sock.close()
+                return
             
             if username in self.clients:
                 utils.send_msg(client_sock, utils.HEADER_ERR, "Username already taken.")
                 client_sock.close()
                 return
 
-            self.clients[username] = client_sock
-            self.addresses[client_sock] = address
-            print(f"New connection: {username} from {address}")
-            
-            # Notify everyone
-            self.broadcast(f"{username} has joined the chat!", "Server")
-            self.update_user_list()
+            if self.stopping.is_set():
+                utils.send_msg(client_sock, utils.HEADER_ERR, "Server is restarting, please reconnect.")
+                client_sock.close()
+                return
+            client_sock.settimeout(None)
+        except Exception as e:
+            print(f"Error during login from {address}: {e}")
+            client_sock.close()
+            return
+
+        self.register(username, client_sock, reader, address)
+        print(f"New connection: {username} from {address}")
+        
+        # Notify everyone
+        self.broadcast(f"{username} has joined the chat!", "Server")
+        self.update_user_list()
+
+        self.serve_client(username, client_sock, reader, address)
+
+    def register(self, username, client_sock, reader, address):
+        self.send_locks[client_sock] = threading.Lock()
+        self.readers[client_sock] = reader
+        self.clients[username] = client_sock
+        self.addresses[client_sock] = address
 
+    def serve_client(self, username, client_sock, reader, address):
+        """Dispatch a logged-in client's messages until it leaves or the server stops.
+
+        On drain or hot restart the loop parks between frames, leaving the
+        connection registered for shutdown() to hand over or close.
+        """
+        ip = address[0]
+        limited = False
+        parked = False
+        try:
             while True:
-                message = client_sock.recv(utils.BUFFER_SIZE).decode(utils.FORMAT)
-                if not message:
+                self.busy.discard(client_sock)
+                if self.stopping.is_set():
+                    parked = True
+                    return
+                if not reader.wait(utils.POLL_INTERVAL):
+                    continue
+                self.busy.add(client_sock)
+
+                frame = utils.recv_frame(reader)
+                if not frame:
                     break
+                message = frame.decode(utils.FORMAT)
+
+                # Every frame counts as a message, charged by its encoded size; raw bytes after
+                # a header are paced by the file buckets
+                size = len(frame)
+                self.count("messages")
+                self.count("bytes", size)
+                if not self.limiter.allow_message(username, ip, size):
+                    self.count("messages_limited")
+                    if message.startswith(RAW_PAYLOAD_HEADERS):
+                        # The payload size is the header's last field; skip it to stay in frame
+                        payload = int(message.rpartition(utils.SEPARATOR)[2])
+                        self.relay_file_data(reader, None, payload, username, ip)
+                    if message.startswith((utils.HEADER_OFFER, utils.HEADER_UPLOAD, utils.HEADER_PROOF)):
+                        # The client waits on this share; fail it by digest so it isn't left hanging
+                        digest = message.split(utils.SEPARATOR, 2)[1]
+                        self.pending_uploads.pop((username, digest), None)
+                        self.challenges.pop((username, digest), None)
+                        self.share_failed(client_sock, digest, "Rate limit exceeded; try sharing again shortly.")
+                    if not limited:
+                        # One ERR per burst of dropped messages, not one per message
+                        limited = True
+                        self.count("limit_errors_sent")
+                        self.send_to(client_sock, utils.HEADER_ERR, "Rate limit exceeded; messages are being dropped.")
+                    continue
+                limited = False
                 
                 # Simple parsing
                 if message.startswith(utils.HEADER_PVT):
                     # Format: PVT<SEP>TargetUser<SEP>Message
                     _, target, content = message.split(utils.SEPARATOR, 2)
-                    self.send_private(target, f"[Private from {username}]: {content}")
+                    if target in self.clients:
+                        msg_id = self.index.add(private_conversation(username, target), username, content)
+                        self.send_private(target, f"[Private from {username}]: {content}{utils.SEPARATOR}{msg_id}")
                 elif message.startswith(utils.HEADER_MSG):
                     # Format: MSG<SEP>Message
                     _, content = message.split(utils.SEPARATOR, 1)
-                    self.broadcast(f"{username}: {content}", username)
+                    msg_id = self.index.add(GENERAL, username, content)
+                    self.broadcast(f"{username}: {content}", username, msg_id)
+                elif message.startswith(utils.HEADER_SEARCH):
+                    # Format: SEARCH<SEP>Conversation (empty = all)<SEP>Query
+                    _, conversation, query = message.split(utils.SEPARATOR, 2)
+                    self.search(client_sock, username, conversation, query)
+                elif message.startswith(utils.HEADER_OFFER):
+                    # Format: OFFER<SEP>Digest<SEP>Filename<SEP>Target1,Target2 (or General)
+                    _, digest, filename, targets = message.split(utils.SEPARATOR, 3)
+                    self.offer_blob(client_sock, username, digest, filename, targets.split(","))
+                elif message.startswith(utils.HEADER_UPLOAD):
+                    # Format: UPLOAD<SEP>Digest<SEP>Size, then Size raw bytes
+                    _, digest, size = message.split(utils.SEPARATOR)
+                    self.upload_blob(reader, client_sock, username, ip, digest, int(size))
+                elif message.startswith(utils.HEADER_PROOF):
+                    # Format: PROOF<SEP>Digest<SEP>Proof
+                    _, digest, proof = message.split(utils.SEPARATOR)
+                    self.check_proof(client_sock, username, digest, proof)
+                elif message.startswith(utils.HEADER_FETCH):
+                    # Format: FETCH<SEP>Digest
+                    _, digest = message.split(utils.SEPARATOR, 1)
+                    self.fetch_blob(client_sock, username, digest)
+                elif message.startswith(utils.HEADER_SIGREQ):
+                    # Format: SIGREQ<SEP>TargetUser<SEP>Filename
+                    _, target, filename = message.split(utils.SEPARATOR)
+                    target_sock = self.clients.get(target)
+                    if target_sock is not None:
+                        self.signature_requests.add((username, target, filename))
+                        self.send_to(target_sock, utils.HEADER_SIGREQ, f"{username}{utils.SEPARATOR}{filename}")
+                    else:
+                        # No signature; the sender falls back to FILE, which reports the missing user
+                        self.send_to(client_sock, utils.HEADER_SIGNATURE,
+                                     utils.SEPARATOR.join([target, filename, "", "0"]))
+                elif message.startswith(utils.HEADER_SIGNATURE):
+                    # Format: SIGNATURE<SEP>TargetUser<SEP>Filename<SEP>BasisDigest<SEP>Size, then Size raw bytes
+                    _, target, filename, basis, size = message.split(utils.SEPARATOR)
+                    size = int(size)
+                    request = (target, username, filename)
+                    if request not in self.signature_requests or size > utils.SIGNATURE_MAX_SIZE:
+                        # Only answers to a pending SIGREQ get through; anything else is skipped
+                        self.relay_file_data(reader, None, size, username, ip)
+                        self.count("signatures_dropped")
+                        continue
+                    self.signature_requests.discard(request)
+                    content = utils.SEPARATOR.join([username, filename, basis, str(size)])
+                    if not self.relay_to(reader, username, ip, target, utils.HEADER_SIGNATURE, content, size):
+                        self.count("signatures_dropped")
+                elif message.startswith(utils.HEADER_DELTA):
+                    # Format: DELTA<SEP>TargetUser<SEP>Filename<SEP>BasisDigest<SEP>Digest<SEP>FileSize<SEP>DeltaSize,
+                    # then DeltaSize raw bytes
+                    _, target, rest = message.split(utils.SEPARATOR, 2)
+                    delta_size = int(rest.rpartition(utils.SEPARATOR)[2])
+                    if self.relay_to(reader, username, ip, target, utils.HEADER_DELTA, f"{username}{utils.SEPARATOR}{rest}", delta_size):
+                        utils.debug(f"Relayed {delta_size}-byte delta from {username} to {target}")
+                    else:
+                        self.send_to(client_sock, utils.HEADER_ERR, f"User {target} not found.")
                 elif message.startswith(utils.HEADER_FILE):
                     # Format: FILE<SEP>TargetUser<SEP>Filename<SEP>FileSize
                     try:
@@ -64,49 +286,237 @@ class ChatServer:
                         _, target, filename, filesize = message.split(utils.SEPARATOR)
                         filesize = int(filesize)
                         
-                        if target in self.clients:
-                            # Forward header to target: FILE<SEP>Sender<SEP>Filename<SEP>FileSize
-                            target_sock = self.clients[target]
-                            header = f"{utils.HEADER_FILE}{utils.SEPARATOR}{username}{utils.SEPARATOR}{filename}{utils.SEPARATOR}{filesize}"
-                            target_sock.send(header.encode(utils.FORMAT))
-                            
-                            print(f"[DEBUG] Relaying {filesize} bytes to {target}...")
-                            # Relay file data
-                            remaining = filesize
-                            while remaining > 0:
-                                chunk_size = min(remaining, utils.BUFFER_SIZE)
-                                data = client_sock.recv(chunk_size)
-                                if not data:
-                                    break
-                                target_sock.send(data)
-                                remaining -= len(data)
+                        # Forward header to target: FILE<SEP>Sender<SEP>Filename<SEP>FileSize
+                        content = f"{username}{utils.SEPARATOR}{filename}{utils.SEPARATOR}{filesize}"
+                        print(f"[DEBUG] Relaying {filesize} bytes to {target}...")
+                        if self.relay_to(reader, username, ip, target, utils.HEADER_FILE, content, filesize):
                             print(f"[DEBUG] Relayed file {filename} from {username} to {target}")
                         else:
-                            # Consume the file data to clear the buffer if target not found
-                            # This prevents the server from interpreting file bytes as commands
-                            remaining = filesize
-                            while remaining > 0:
-                                chunk_size = min(remaining, utils.BUFFER_SIZE)
-                                client_sock.recv(chunk_size)
-                                remaining -= chunk_size
-                            utils.send_msg(client_sock, utils.HEADER_ERR, f"User {target} not found.")
+                            self.send_to(client_sock, utils.HEADER_ERR, f"User {target} not found.")
 
                     except ValueError:
                         print(f"Error parsing file header from {username}")
                 else:
                     # Default broadcast
-                    self.broadcast(f"{username}: {message}", username)
+                    msg_id = self.index.add(GENERAL, username, message)
+                    self.broadcast(f"{username}: {message}", username, msg_id)
 
         except Exception as e:
             print(f"Error handling client {username}: {e}")
         finally:
-            if username:
+            self.busy.discard(client_sock)
+            if not parked:
                 self.remove_client(username)
+                self.send_locks.pop(client_sock, None)
+                self.readers.pop(client_sock, None)
+                self.addresses.pop(client_sock, None)
+                self.limiter.release(username, ip)
+                self.forget_blobs(username)
+                self.signature_requests -= {request for request in self.signature_requests if username in request[:2]}
                 client_sock.close()
 
+    def relay_to(self, reader, username, ip, target, header, content, size):
+        """Forward a header and the size raw bytes after it to target.
+
+        If target isn't connected the bytes are still consumed, so they can't be
+        mistaken for commands, and False is returned.
+        """
+        target_sock = self.clients.get(target)
+        if target_sock is None:
+            self.relay_file_data(reader, None, size, username, ip)
+            return False
+        if not self.limiter.limits("file"):
+            # Hold the target's lock so no broadcast lands inside the raw bytes
+            with self.send_locks[target_sock]:
+                utils.send_msg(target_sock, header, content)
+                self.relay_file_data(reader, target_sock.sendall, size, username, ip)
+            return True
+
+        # Throttled: take the paced read into a spool first, so the pauses don't hold
+        # the target's lock and stall everyone broadcasting to it
+        with tempfile.SpooledTemporaryFile(max_size=RELAY_SPOOL_SIZE) as spool:
+            if self.relay_file_data(reader, spool.write, size, username, ip) < size:
+                return True  # Sender left mid-transfer; don't hand the target a truncated payload
+            spool.seek(0)
+            lock = self.send_locks.get(target_sock)
+            if lock is None:
+                return False  # Target left while we were reading
+            with lock:
+                utils.send_msg(target_sock, header, content)
+                for chunk in iter(lambda: spool.read(utils.RELAY_BUFFER_SIZE), b""):
+                    target_sock.sendall(chunk)
+        return True
+
+    def relay_file_data(self, reader, write, filesize, username=None, ip=None):
+        """Pass filesize raw bytes from reader to write() (or discard them if None).
+
+        Pauses between chunks when the sender exceeds its file bandwidth limit.
+        Returns the number of bytes read, short only if the sender disconnected.
+        """
+        remaining = filesize
+        while remaining > 0:
+            data = reader.read1(min(remaining, utils.RELAY_BUFFER_SIZE))
+            if not data:
+                break
+            if write is not None:
+                write(data)
+            remaining -= len(data)
+            self.count("file_bytes", len(data))
+            delay = self.limiter.file_delay(username, ip, len(data))
+            if delay:
+                self.count("file_throttled_seconds", delay)
+                time.sleep(delay)
+        return filesize - remaining
+
+    def offer_blob(self, client_sock, username, digest, filename, targets):
+        """Share a blob with targets; ask for the upload only if the store lacks it."""
+        if self.blobs is None:
+            self.share_failed(client_sock, digest, "File sharing is not enabled on this server.")
+        elif not BlobStore.valid(digest):
+            self.share_failed(client_sock, digest, "Invalid file hash.")
+        else:
+            # Challenge every offer, stored or not, so the reply can't tell anyone which files are here
+            nonce = secrets.token_hex(16)
+            self.pending_uploads[(username, digest)] = (filename, targets)
+            self.challenges[(username, digest)] = nonce
+            self.send_to(client_sock, utils.HEADER_OFFER, utils.SEPARATOR.join([digest, "PROVE", nonce]))
+
+    def check_proof(self, client_sock, username, digest, proof):
+        """Skip the upload if the client proved it has the stored blob; otherwise ask for the file."""
+        nonce = self.challenges.pop((username, digest), None)
+        offer = self.pending_uploads.get((username, digest))
+        if nonce is None or offer is None:
+            return
+        if digest in self.blobs:
+            try:
+                expected = utils.possession_proof(self.blobs.path(digest), nonce)
+            except OSError:
+                expected = ""  # Evicted meanwhile
+            filename, targets = offer
+            if expected and hmac.compare_digest(proof, expected) and self.deliver_blob(
+                    client_sock, username, digest, filename, targets, uploaded=False):
+                del self.pending_uploads[(username, digest)]
+                return
+        # The same answer for a missing blob and a wrong proof
+        self.send_to(client_sock, utils.HEADER_OFFER, f"{digest}{utils.SEPARATOR}NEED")
+
+    def share_failed(self, client_sock, digest, reason):
+        """Answer an OFFER (or its UPLOAD) with OFFER<SEP>Digest<SEP>FAIL<SEP>Reason."""
+        self.send_to(client_sock, utils.HEADER_OFFER, utils.SEPARATOR.join([digest, "FAIL", reason]))
+
+    def upload_blob(self, reader, client_sock, username, ip, digest, size):
+        """Store an upload the client was asked for, verifying its hash, then deliver it."""
+        offer = self.pending_uploads.pop((username, digest), None)
+        if offer is None or self.blobs is None:
+            self.relay_file_data(reader, None, size, username, ip)
+            self.share_failed(client_sock, digest, "Unexpected upload.")
+            return
+        if size > self.blobs.max_bytes:
+            # Refuse before writing anything; commit() would only reject it once the disk had filled
+            self.relay_file_data(reader, None, size, username, ip)
+            self.share_failed(client_sock, digest, f"File too large to share (limit {self.blobs.max_bytes} bytes).")
+            return
+
+        hasher = hashlib.sha256()
+        with self.blobs.new_upload() as tmp:
+            def write(data):
+                tmp.write(data)
+                hasher.update(data)
+            received = self.relay_file_data(reader, write, size, username, ip)
+        filename, targets = offer
+        if received != size or hasher.hexdigest() != digest:
+            os.unlink(tmp.name)
+            self.share_failed(client_sock, digest, f"Upload of {filename} failed verification.")
+            return
+        try:
+            self.blobs.commit(tmp.name, digest, size)
+        except BlobStoreFull as e:
+            self.share_failed(client_sock, digest, str(e))
+            return
+        if not self.deliver_blob(client_sock, username, digest, filename, targets, uploaded=True):
+            self.share_failed(client_sock, digest, "The file was evicted before it could be shared; try again.")
+
+    def deliver_blob(self, client_sock, username, digest, filename, targets, uploaded):
+        """Announce a stored blob to its recipients; each pulls it with FETCH when it likes.
+
+        Returns False, announcing nothing, if the blob is no longer stored.
+        """
+        if GENERAL in targets:
+            recipients, conversation = [name for name in list(self.clients) if name != username], GENERAL
+        else:
+            recipients, conversation = [name for name in targets if name in self.clients and name != username], ""
+        # Pin the blob until every recipient has fetched it (or left)
+        size = self.blobs.pin(digest, len(recipients))
+        if size is None:
+            return False
+        notice = utils.SEPARATOR.join([digest, str(size), filename, username, conversation])
+        for name in recipients:
+            self.deliveries.setdefault(name, collections.Counter())[digest] += 1
+            self.blob_access.setdefault(name, set()).add(digest)
+            target_sock = self.clients.get(name)
+            if target_sock is not None:
+                self.send_to(target_sock, utils.HEADER_BLOB, notice)
+        self.count("blob_uploads" if uploaded else "blob_uploads_skipped")
+        self.send_to(client_sock, utils.HEADER_SHARED, f"{digest}{utils.SEPARATOR}{len(recipients)}{utils.SEPARATOR}{int(uploaded)}")
+        return True
+
+    def fetch_blob(self, client_sock, username, digest):
+        """Stream a stored blob to the client as BLOBDATA<SEP>Digest<SEP>Size plus raw bytes.
+
+        Only blobs the user was sent, and hasn't fetched yet, are served; knowing a hash isn't enough.
+        """
+        grants = self.blob_access.get(username, set())
+        try:
+            if digest not in grants or not self.blobs.has(digest):
+                raise FileNotFoundError(digest)
+            f = open(self.blobs.path(digest), 'rb')
+        except OSError:
+            grants.discard(digest)
+            self.send_to(client_sock, utils.HEADER_ERR, "That file is no longer available on the server.")
+            return
+        grants.discard(digest)
+        # The open file stays readable even if the blob is evicted, so the pin can go now
+        pending = self.deliveries.get(username)
+        if pending and pending[digest] > 0:
+            pending[digest] -= 1
+            if not pending[digest]:
+                del pending[digest]
+            self.blobs.release(digest)
+
+        with f, self.send_locks[client_sock]:
+            size = os.fstat(f.fileno()).st_size
+            utils.send_msg(client_sock, utils.HEADER_BLOBDATA, f"{digest}{utils.SEPARATOR}{size}")
+            # Zero-copy for plain TCP; ssl sockets fall back to a send loop
+            client_sock.sendfile(f)
+        self.count("blob_bytes_served", size)
+
+    def forget_blobs(self, username):
+        """Unpin blobs a departing user never fetched and drop their unfinished offers.
+
+        Their grants stay, so they can still fetch after reconnecting, for as long as the blobs are stored.
+        """
+        for digest, count in self.deliveries.pop(username, {}).items():
+            self.blobs.release(digest, count)
+        for key in [key for key in self.pending_uploads if key[0] == username]:
+            del self.pending_uploads[key]
+            self.challenges.pop(key, None)
+        grants = self.blob_access.get(username)
+        if grants is not None:
+            grants.intersection_update([digest for digest in grants if digest in self.blobs])
+            if not grants:
+                del self.blob_access[username]
+
+    def search(self, client_sock, username, conversation, query):
+        """Answer a SEARCH with ranked hits from conversations username can see."""
+        conversations = self.index.conversations_for(username, conversation)
+        msg_ids, partial = self.index.search(query, conversations, utils.SEARCH_LIMIT)
+        hits = [self.index.hit(msg_id, username) for msg_id in msg_ids]
+        # partial: the search hit its work limit, so older matches may be missing
+        self.send_to(client_sock, utils.HEADER_SEARCH, json.dumps({"query": query, "hits": hits, "partial": partial}))
+
     def send_private(self, target_user, message):
         if target_user in self.clients:
-            utils.send_msg(self.clients[target_user], utils.HEADER_PVT, message)
+            self.send_to(self.clients[target_user], utils.HEADER_PVT, message)
 
     def remove_client(self, username):
         if username in self.clients:
@@ -118,18 +528,175 @@ class ChatServer:
         """Send the updated list of users to all clients."""
         users = ",".join(self.clients.keys())
         print(f"[DEBUG] Sending user list: {users}")
-        for client_sock in self.clients.values():
+        for client_sock in list(self.clients.values()):
             try:
-                utils.send_msg(client_sock, utils.HEADER_LIST, users)
+                self.send_to(client_sock, utils.HEADER_LIST, users)
             except Exception as e:
                 print(f"[DEBUG] Error sending user list: {e}")
 
+    def spawn(self, target, *args):
+        self.threads = [thread for thread in self.threads if thread.is_alive()]
+        thread = threading.Thread(target=target, args=args)
+        thread.start()
+        self.threads.append(thread)
+
     def start(self):
+        """Accept connections until a drain or hot restart is requested, then shut down."""
+        self.server.settimeout(utils.POLL_INTERVAL)
+        while not self.stopping.is_set():
+            try:
+                client_sock, address = self.server.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            client_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.spawn(self.handle_client, client_sock, address)
+        self.shutdown()
+
+    def shutdown(self):
+        """Let in-flight work finish, then hand clients to a new process or disconnect them."""
+        self.stopping.set()
+        deadline = time.monotonic() + utils.DRAIN_TIMEOUT
+        for thread in self.threads:
+            thread.join(max(0, deadline - time.monotonic()))
+        if any(thread.is_alive() for thread in self.threads):
+            # A peer went quiet mid-frame (or stopped reading); don't let it hold up everyone else
+            self.drop_stragglers()
+            for thread in self.threads:
+                thread.join()
+
+        if self.handoff_conn:
+            try:
+                self.hand_off()
+                return
+            except Exception as e:
+                print(f"Hot restart failed, draining instead: {e}")
+
+        self.broadcast("Server is shutting down.", "Server")
+        for client_sock in list(self.clients.values()):
+            client_sock.close()
+        self.clients.clear()
+        self.server.close()
+        self.close_control()
+
+    def drop_stragglers(self):
+        """Disconnect clients still mid-frame, or whose sends are stuck, so their handlers return."""
+        for username, client_sock in list(self.clients.items()):
+            lock = self.send_locks.get(client_sock)
+            if client_sock in self.busy or (lock is not None and lock.locked()):
+                print(f"Disconnecting {username}, who stalled the shutdown")
+                try:
+                    # Wakes any recv or send blocked on it; the handler then cleans up as usual
+                    client_sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    def hand_off(self):
+        """Send the listener, client sockets and registry to the process that asked for them."""
+        clients = list(self.clients.items())
+        state = {
+            "clients": [
+                {
+                    "username": username,
+                    "address": list(self.addresses[client_sock]),
+                    "pending": base64.b64encode(self.readers[client_sock].pending()).decode("ascii"),
+                }
+                for username, client_sock in clients
+            ],
+            "metrics": dict(self.metrics),
+            "pending_uploads": [
+                [username, filename, digest, targets]
+                for (username, digest), (filename, targets) in self.pending_uploads.items()
+            ],
+            "deliveries": {username: dict(pending) for username, pending in self.deliveries.items()},
+            "challenges": [[username, digest, nonce] for (username, digest), nonce in self.challenges.items()],
+            "blob_access": {username: sorted(digests) for username, digests in self.blob_access.items()},
+        }
+        fds = [self.server.fileno()] + [client_sock.fileno() for _, client_sock in clients]
+        handoff.send_state(self.handoff_conn, state, fds)
+        if self.handoff_conn.recv(2) != b"OK":
+            raise ConnectionError("New process did not acknowledge the handoff")
+
+        # Close only our copies; the connections stay open in the new process
+        for _, client_sock in clients:
+            client_sock.close()
+        self.clients.clear()
+        self.server.close()
+        self.close_control()
+        self.handoff_conn.close()
+        print(f"Handed off {len(clients)} connections")
+
+    def listen_for_handoff(self, path):
+        """Serve hot-restart requests from a new server process on a Unix socket."""
+        self.control_path = path
+        self.control = handoff.listen(path)
+        threading.Thread(target=self.await_handoff, daemon=True).start()
+
+    def await_handoff(self):
         while True:
-            client_sock, address = self.server.accept()
-            thread = threading.Thread(target=self.handle_client, args=(client_sock, address))
-            thread.start()
+            try:
+                conn, _ = self.control.accept()
+            except OSError:
+                return
+            if self.tls_context:
+                # TLS session state lives inside this process and cannot follow the descriptors
+                print("Refusing hot restart: not supported for TLS connections")
+                conn.close()
+                continue
+            self.handoff_conn = conn
+            self.stopping.set()
+            return
+
+    def close_control(self):
+        if self.control:
+            self.control.close()
+            # After a handoff the path belongs to the new process, which rebinds it itself
+            if self.handoff_conn is None and os.path.exists(self.control_path):
+                os.unlink(self.control_path)
+            self.control = None
 
 if __name__ == "__main__":
-    server = ChatServer()
+    parser = argparse.ArgumentParser(description="Chat server")
+    parser.add_argument("--host", default=utils.HOST)
+    parser.add_argument("--port", type=int, default=utils.PORT)
+    parser.add_argument("--tls-cert", help="PEM certificate; enables TLS")
+    parser.add_argument("--tls-key", help="PEM private key for --tls-cert")
+    # Token-bucket limits (per second, 0 = unlimited); bursts of ratelimit.BURST_SECONDS are allowed
+    parser.add_argument("--user-msg-rate", type=float, default=utils.USER_MSG_RATE)
+    parser.add_argument("--ip-msg-rate", type=float, default=utils.IP_MSG_RATE)
+    parser.add_argument("--user-byte-rate", type=float, default=utils.USER_BYTE_RATE)
+    parser.add_argument("--ip-byte-rate", type=float, default=utils.IP_BYTE_RATE)
+    parser.add_argument("--user-file-rate", type=float, default=utils.USER_FILE_RATE)
+    parser.add_argument("--ip-file-rate", type=float, default=utils.IP_FILE_RATE)
+    # Hot restart: a server started with --takeover adopts the sockets of the one on --handoff-socket
+    parser.add_argument("--handoff-socket", help="Unix socket path for hot-restart handoffs")
+    parser.add_argument("--takeover", action="store_true", help="Take over from the server on --handoff-socket")
+    parser.add_argument("--blob-dir", default=utils.BLOB_DIR, help="Where shared files are stored by hash")
+    parser.add_argument("--blob-max-mb", type=int, default=utils.BLOB_MAX_MB, help="Store size limit; 0 disables sharing")
+    parser.add_argument("--history", default=utils.HISTORY_FILE, help="Message log behind search; kept across restarts")
+    args = parser.parse_args()
+    if args.takeover and not args.handoff_socket:
+        parser.error("--takeover requires --handoff-socket")
+    if args.takeover and args.tls_cert:
+        parser.error("--takeover is not supported with TLS")
+
+    limiter = RateLimiter(
+        msg=(args.user_msg_rate, args.ip_msg_rate),
+        bytes=(args.user_byte_rate, args.ip_byte_rate),
+        file=(args.user_file_rate, args.ip_file_rate),
+    )
+    # On takeover the old process still owns the store until the handoff; leave its temp files alone
+    blobs = BlobStore(args.blob_dir, args.blob_max_mb * 1024 * 1024, clean=not args.takeover) if args.blob_max_mb else None
+    # Replaying the history can take a while; on takeover it happens before the old process stops
+    index = SearchIndex(args.history)
+    if args.takeover:
+        server = ChatServer.takeover(args.handoff_socket, limiter=limiter, blobs=blobs, index=index)
+    else:
+        server = ChatServer(args.host, args.port, args.tls_cert, args.tls_key, limiter, blobs=blobs, index=index)
+    if args.handoff_socket:
+        server.listen_for_handoff(args.handoff_socket)
+
+    # SIGTERM drains: stop accepting, let in-flight file relays finish, then disconnect
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.stopping.set())
     server.start()
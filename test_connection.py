@@ -1,31 +1,457 @@
-import socket
+import asyncio
+import contextlib
+import hashlib
+import io
+import json
 import utils
 import time
 import sys
+import os
+import queue
+import tempfile
+import threading
+import ratelimit
+from ratelimit import RateLimiter
+from blobstore import BlobStore
+from client_core import AsyncChatConnection, ChatConnection, basis_path
+from search import SearchIndex, private_conversation
+from server import ChatServer
+
+@contextlib.contextmanager
+def running_server(**kwargs):
+    """A ChatServer on a free local port, drained when the block exits. Yields (server, port)."""
+    server = ChatServer("127.0.0.1", 0, **kwargs)
+    thread = threading.Thread(target=server.start, daemon=True)
+    thread.start()
+    try:
+        yield server, server.server.getsockname()[1]
+    finally:
+        server.stopping.set()
+        thread.join()
 
 def test_connection():
     try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.connect((utils.HOST, utils.PORT))
-        
-        # Send username
-        sock.send("TestBot".encode(utils.FORMAT))
-        
+        conn = ChatConnection(utils.HOST, utils.PORT, "TestBot").connect()
+
         # Receive welcome/broadcast
         # We expect multiple messages: "TestBot has joined..." and User List
-        
+
         # Give it a second
         time.sleep(1)
-        
+
         # Send a message
-        utils.send_msg(sock, utils.HEADER_MSG, "Hello World")
-        
+        conn.send("Hello World")
+
         print("Connection and send successful")
-        sock.close()
+        conn.close()
         sys.exit(0)
     except Exception as e:
         print(f"Test failed: {e}")
         sys.exit(1)
 
+def test_tls_resumption():
+    # Self-contained: throwaway certificate and a server on a free local port
+    with tempfile.TemporaryDirectory() as tmp:
+        certfile = os.path.join(tmp, "cert.pem")
+        keyfile = os.path.join(tmp, "key.pem")
+        utils.generate_self_signed_cert(certfile, keyfile)
+
+        with running_server(certfile=certfile, keyfile=keyfile) as (server, port):
+            context = utils.make_client_context(certfile)
+
+            reused = []
+            for name in ("TlsBot1", "TlsBot2"):
+                sock = utils.open_connection("127.0.0.1", port, context, "localhost")
+                reader = utils.make_reader(sock)
+                utils.send_frame(sock, name.encode(utils.FORMAT))
+                message = utils.recv_msg(reader)
+                assert message is not None
+                utils.save_tls_session(sock, "127.0.0.1", port)
+                reused.append(sock.session_reused)
+                reader.close()
+                sock.close()
+
+            assert reused == [False, True]
+
+def test_rate_limit():
+    with running_server(limiter=RateLimiter(msg=(1, 0))) as (server, port):
+        sock = utils.open_connection("127.0.0.1", port)
+        reader = utils.make_reader(sock)
+        utils.send_frame(sock, "FloodBot".encode(utils.FORMAT))
+        for i in range(10):
+            utils.send_msg(sock, utils.HEADER_MSG, f"spam {i}")
+
+        message = utils.recv_msg(reader)
+        while not message.startswith(utils.HEADER_ERR):
+            message = utils.recv_msg(reader)
+        assert "Rate limit" in message
+
+        # A burst of BURST_SECONDS messages passes; the rest are dropped with a single ERR
+        time.sleep(0.2)
+        assert server.metrics["messages_limited"] == 10 - ratelimit.BURST_SECONDS
+        assert server.metrics["limit_errors_sent"] == 1
+
+        # Empty file headers count as messages too, and refused ones keep the stream in frame
+        time.sleep(ratelimit.BURST_SECONDS)
+        for i in range(10):
+            utils.send_msg(sock, utils.HEADER_FILE, f"FloodBot{utils.SEPARATOR}x{utils.SEPARATOR}3")
+            sock.sendall(b"abc")
+        utils.send_msg(sock, utils.HEADER_MSG, "still in frame")
+        time.sleep(0.2)
+        assert server.metrics["messages_limited"] == 2 * (10 - ratelimit.BURST_SECONDS) + 1
+        reader.close()
+        sock.close()
+
+        # A dropped share is failed by its digest, so the client stops waiting on it
+        with tempfile.NamedTemporaryFile() as f:
+            conn = ChatConnection("127.0.0.1", port, "SharingBot").connect()
+            conn.send("one")
+            conn.send("two")
+            digest = conn.share_file("General", f.name)
+            failed = next(e for e in conn if e.digest == digest)
+            assert failed.kind == "error" and "Rate limit" in failed.text
+            assert not conn.offers
+            conn.close()
+
+def test_throttled_relay_does_not_block_broadcasts():
+    with running_server(limiter=RateLimiter(file=(256 * 1024, 0))) as (server, port):
+        alice = ChatConnection("127.0.0.1", port, "alice").connect()
+        bob = ChatConnection("127.0.0.1", port, "bob").connect()
+        carol = ChatConnection("127.0.0.1", port, "carol").connect()
+        time.sleep(0.1)
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(os.urandom(2 * 1024 * 1024))
+            f.flush()
+            threading.Thread(target=alice.send_file, args=("bob", f.name), daemon=True).start()
+            time.sleep(0.2)
+            # The relay to bob is paused on alice's file bucket; carol's message must reach bob while it is
+            carol.send("hello")
+            event = next(e for e in bob if e.kind == "file" or e.text == "carol: hello")
+            assert event.kind == "message"
+            assert server.metrics["file_bytes"] < 2 * 1024 * 1024
+
+        for conn in (alice, bob, carol):
+            conn.close()
+
+def test_hot_restart():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "handoff.sock")
+        store = os.path.join(tmp, "store")
+        old = ChatServer("127.0.0.1", 0, blobs=BlobStore(store, 1024 * 1024))
+        port = old.server.getsockname()[1]
+        old.listen_for_handoff(path)
+        old_thread = threading.Thread(target=old.start)
+        old_thread.start()
+
+        socks = {}
+        for name in ("alice", "bob"):
+            sock = utils.open_connection("127.0.0.1", port)
+            utils.send_frame(sock, name.encode(utils.FORMAT))
+            socks[name] = (sock, utils.make_reader(sock))
+        time.sleep(0.2)
+
+        # The new store is opened while the old process is still mid-upload
+        upload = old.blobs.new_upload()
+        new_blobs = BlobStore(store, 1024 * 1024, clean=False)
+        upload.write(b"late blob")
+        upload.close()
+        digest = hashlib.sha256(b"late blob").hexdigest()
+        old.blobs.commit(upload.name, digest, 9)
+
+        new = ChatServer.takeover(path, blobs=new_blobs)
+        old_thread.join()
+        threading.Thread(target=new.start, daemon=True).start()
+        assert sorted(new.clients) == ["alice", "bob"]
+        assert new.blobs.has(digest)
+
+        # Same connections, new process: nobody had to reconnect
+        utils.send_msg(socks["alice"][0], utils.HEADER_MSG, "after restart")
+        message = utils.recv_msg(socks["bob"][1])
+        while "after restart" not in message:
+            message = utils.recv_msg(socks["bob"][1])
+
+        # The handed-over listener keeps accepting
+        late = utils.open_connection("127.0.0.1", port)
+        utils.send_frame(late, b"carol")
+        assert utils.recv_msg(utils.make_reader(late)) is not None
+
+        new.stopping.set()
+        for sock, _ in socks.values():
+            sock.close()
+        late.close()
+
+def test_shutdown_drops_stalled_client():
+    server = ChatServer("127.0.0.1", 0)
+    port = server.server.getsockname()[1]
+    thread = threading.Thread(target=server.start)
+    thread.start()
+
+    stalled = utils.open_connection("127.0.0.1", port)
+    utils.send_frame(stalled, b"stalled")
+    idle = utils.open_connection("127.0.0.1", port)
+    utils.send_frame(idle, b"idle")
+    time.sleep(0.2)
+    # Half a length prefix, then silence: the handler is stuck mid-frame
+    stalled.sendall(b"\x00\x00")
+    time.sleep(0.2)
+
+    drain_timeout, utils.DRAIN_TIMEOUT = utils.DRAIN_TIMEOUT, 0.5
+    try:
+        server.stopping.set()
+        thread.join(5)
+        assert not thread.is_alive()
+    finally:
+        utils.DRAIN_TIMEOUT = drain_timeout
+    stalled.close()
+    idle.close()
+
+def test_client_core():
+    with running_server() as (server, port):
+        with tempfile.TemporaryDirectory() as tmp:
+            source = os.path.join(tmp, "notes.bin")
+            with open(source, "wb") as f:
+                f.write(os.urandom(300 * 1024))
+
+            receiver = ChatConnection("127.0.0.1", port, "sync_rx", files_dir=os.path.join(tmp, "in")).connect()
+            sender = ChatConnection("127.0.0.1", port, "sync_tx").connect()
+            events = iter(receiver)
+
+            sender.send_private("sync_rx", "file coming")
+            sender.send_file("sync_rx", source)
+            event = next(e for e in events if e.kind == "private")
+            assert (event.sender, event.text) == ("sync_tx", "file coming")
+            event = next(e for e in events if e.kind == "file")
+            assert (event.sender, event.text, event.size) == ("sync_tx", "notes.bin", 300 * 1024)
+            with open(source, "rb") as a, open(event.path, "rb") as b:
+                assert a.read() == b.read()
+
+            async def async_bot():
+                async with AsyncChatConnection("127.0.0.1", port, "async_bot") as bot:
+                    for i in range(1000):
+                        await bot.send(f"alert {i}")
+                    async for event in bot:
+                        if event.kind == "users":
+                            return event.text
+            assert "async_bot" in asyncio.run(async_bot())
+
+            # Every alert arrives, in order, on the sync side
+            alerts = []
+            for event in events:
+                if event.kind == "message" and event.text.startswith("async_bot: alert"):
+                    alerts.append(event.text)
+                    if len(alerts) == 1000:
+                        break
+            assert alerts == [f"async_bot: alert {i}" for i in range(1000)]
+            sender.close()
+            receiver.close()
+
+def test_search():
+    with running_server() as (server, port):
+        alice = ChatConnection("127.0.0.1", port, "alice").connect()
+        bob = ChatConnection("127.0.0.1", port, "bob").connect()
+        carol = ChatConnection("127.0.0.1", port, "carol").connect()
+        time.sleep(0.1)
+        alice.send("Deploy of build 41 failed")
+        alice.send("deploy of build 42 succeeded")
+        alice.send_private("bob", "secret deploy notes")
+        time.sleep(0.1)
+
+        delivered = next(e for e in carol if e.kind == "message" and e.id is not None)
+        assert delivered.text == "alice: Deploy of build 41 failed"
+
+        # Newest first; private messages only visible to their participants
+        bob.search("DEPLOY build")
+        event = next(e for e in bob if e.kind == "search")
+        assert [hit["text"] for hit in event.hits] == ["deploy of build 42 succeeded", "Deploy of build 41 failed"]
+        bob.search("deploy")
+        event = next(e for e in bob if e.kind == "search")
+        assert event.hits[0]["text"] == "secret deploy notes"
+        assert event.hits[0]["conversation"] == "alice"
+        carol.search("secret")
+        event = next(e for e in carol if e.kind == "search")
+        assert event.hits == []
+
+        # Ids in search hits match the ids on the delivered messages
+        bob.search("41", "General")
+        hit = next(e for e in bob if e.kind == "search").hits[0]
+        assert hit["id"] == delivered.id
+
+        # Long runs where common terms don't co-occur are skipped over, well within the probe budget
+        index = SearchIndex()
+        index.add("General", "x", "alpha beta")
+        for i in range(200000):
+            index.add("General", "x", "alpha" if i < 100000 else "beta")
+        assert index.search("alpha beta", ["General"]) == ([0], False)
+        # Interleaved ones can't be skipped; past the budget the answer says it may be incomplete
+        index = SearchIndex()
+        index.add("General", "x", "alpha beta target")
+        for i in range(40000):
+            index.add("General", "x", "alpha" if i % 2 else "beta")
+        assert index.search("alpha beta", ["General"]) == ([], True)
+
+        # History lives in a log that a restarted (or hot-restarting) server picks up
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "history.log")
+            old = SearchIndex(path)
+            old.add("General", "alice", "before restart")
+            new = SearchIndex(path)  # Opened while the old process is still writing
+            old.add(private_conversation("alice", "bob"), "alice", "after open\nsecond line")
+            new.refresh()
+            (msg_id,), _ = new.search("after", new.conversations_for("bob"))
+            assert new.hit(msg_id, "bob")["text"] == "after open\nsecond line"
+            assert new.hit(msg_id, "bob")["conversation"] == "alice"
+            # A line torn by a crash keeps its id and doesn't corrupt the next one
+            with open(path, "ab") as f:
+                f.write(b'["General", "ali')
+            assert SearchIndex(path).add("General", "bob", "survivor") == 3
+            assert SearchIndex(path).search("survivor", ["General"]) == ([3], False)
+
+        for conn in (alice, bob, carol):
+            conn.close()
+
+def test_blob_share():
+    with tempfile.TemporaryDirectory() as tmp:
+        blobs = BlobStore(os.path.join(tmp, "store"), 3 * 1024 * 1024)
+        with running_server(blobs=blobs) as (server, port):
+            files_dir = os.path.join(tmp, "received")
+            alice = ChatConnection("127.0.0.1", port, "alice").connect()
+            bob = ChatConnection("127.0.0.1", port, "bob", files_dir=files_dir).connect()
+            carol = ChatConnection("127.0.0.1", port, "carol", files_dir=files_dir).connect()
+            time.sleep(0.1)
+            report = os.path.join(tmp, "report.bin")
+            with open(report, "wb") as f:
+                f.write(os.urandom(2 * 1024 * 1024))
+
+            # First share uploads once for the whole room
+            digest = alice.share_file("General", report)
+            shared = next(e for e in alice if e.kind == "shared")
+            assert (shared.digest, shared.count, shared.size) == (digest, 2, 2 * 1024 * 1024)
+            for conn in (bob, carol):
+                notice = next(e for e in conn if e.kind == "blob")
+                assert (notice.sender, notice.text, notice.conversation) == ("alice", "report.bin", "General")
+                conn.fetch(notice.digest)
+                received = next(e for e in conn if e.kind == "file")
+                with open(received.path, "rb") as a, open(report, "rb") as b:
+                    assert a.read() == b.read()
+
+            # Sending it again only sends the hash
+            alice.share_file(["bob"], report)
+            shared = next(e for e in alice if e.kind == "shared")
+            assert (shared.count, shared.size) == (1, 0)
+            assert server.metrics["blob_uploads"] == 1 and server.metrics["blob_uploads_skipped"] == 1
+            assert blobs.refs[digest] == 1  # Pinned until bob fetches it
+            assert blobs.pin("0" * 64) is None  # Nothing to pin, nothing announced
+
+            # Anyone holding the file skips the upload, from any session...
+            dave = ChatConnection("127.0.0.1", port, "dave", files_dir=files_dir).connect()
+            dave.share_file(["dave"], report)
+            assert next(e for e in dave if e.kind == "shared").size == 0
+            # ...but knowing the hash is not enough: outsiders can't fetch it or get it shared
+            dave.fetch(digest)
+            assert "no longer available" in next(e for e in dave if e.kind == "error").text
+            forged = os.path.join(tmp, "forged.bin")
+            with open(forged, "wb") as f:
+                f.write(os.urandom(2 * 1024 * 1024))
+            dave.offers[digest] = (forged, None)
+            dave._send(utils.HEADER_OFFER, utils.SEPARATOR.join([digest, "report.bin", "dave"]))
+            assert "failed verification" in next(e for e in dave if e.kind == "error").text
+            dave.close()
+
+            # One bigger than the whole store is refused before any of it is written
+            huge = os.path.join(tmp, "huge.bin")
+            with open(huge, "wb") as f:
+                f.truncate(4 * 1024 * 1024)
+            huge_digest = alice.share_file("carol", huge)
+            failed = next(e for e in alice if e.kind == "error")
+            assert "too large" in failed.text and failed.digest == huge_digest
+            assert not [name for name in os.listdir(blobs.root) if name.startswith(".upload-")]
+
+            # A second blob that doesn't fit can't evict the pinned one...
+            other = os.path.join(tmp, "other.bin")
+            with open(other, "wb") as f:
+                f.write(os.urandom(2 * 1024 * 1024))
+            other_digest = alice.share_file("carol", other)
+            failed = next(e for e in alice if e.kind == "error")
+            assert "full" in failed.text and failed.digest == other_digest
+            assert other_digest not in alice.offers
+            # ...but once bob has it (from a new session, even), least recently used blobs make room
+            bob.close()
+            while "bob" in server.clients:
+                time.sleep(0.01)
+            bob = ChatConnection("127.0.0.1", port, "bob", files_dir=files_dir).connect()
+            bob.fetch(digest)
+            next(e for e in bob if e.kind == "file")
+            alice.share_file("carol", other)
+            assert next(e for e in alice if e.kind == "shared").size == 2 * 1024 * 1024
+            assert not blobs.has(digest)
+
+            for conn in (alice, bob, carol):
+                conn.close()
+
+def test_delta_transfer():
+    with running_server() as (server, port):
+        with tempfile.TemporaryDirectory() as tmp:
+            alice = ChatConnection("127.0.0.1", port, "alice").connect()
+            bob = ChatConnection("127.0.0.1", port, "bob", files_dir=os.path.join(tmp, "received")).connect()
+            # Deltas need each side's events read while send_file waits for the signature
+            bob_files = queue.Queue()
+            def read_events(conn, keep=()):
+                try:
+                    for event in conn:
+                        if event.kind in keep:
+                            bob_files.put(event)
+                except OSError:
+                    pass  # Closed at the end of the test
+            threading.Thread(target=read_events, args=(bob, ("file", "error", "private")), daemon=True).start()
+            threading.Thread(target=read_events, args=(alice,), daemon=True).start()
+            time.sleep(0.1)
+
+            report = os.path.join(tmp, "report.bin")
+            content = bytearray(os.urandom(1024 * 1024))
+            with open(report, "wb") as f:
+                f.write(content)
+            # Nothing to diff against yet, so the whole file goes
+            assert alice.send_file("bob", report, delta=True) == len(content)
+            first = bob_files.get(timeout=5)
+            assert first.kind == "file"
+            # Receiving only notes the file; its signature waits until alice asks for one
+            with open(basis_path(bob.files_dir, "alice", "report.bin")) as f:
+                assert json.load(f)["digest"] == first.digest
+
+            # A lightly edited version only sends the changed blocks
+            content[1000:1010] = b"x" * 10
+            content[500000:500000] = b"inserted"
+            del content[800000:800100]
+            with open(report, "wb") as f:
+                f.write(content)
+            sent = alice.send_file("bob", report, delta=True)
+            assert sent < len(content) // 20
+            second = bob_files.get(timeout=5)
+            assert second.kind == "file" and second.path != first.path
+            with open(second.path, "rb") as f:
+                assert f.read() == content
+
+            # If bob's copy changed, he has no usable basis and gets the whole file
+            with open(second.path, "ab") as f:
+                f.write(b"local edit")
+            assert alice.send_file("bob", report, delta=True) == len(content)
+            assert bob_files.get(timeout=5).kind == "file"
+
+            # Signatures bob never asked for are dropped, however many arrive
+            mallory = ChatConnection("127.0.0.1", port, "mallory").connect()
+            for _ in range(5000):
+                mallory._send(utils.HEADER_SIGNATURE, utils.SEPARATOR.join(["bob", "report.bin", "", "0"]))
+            junk = b"j" * 1000
+            mallory._send_stream(utils.SEPARATOR.join([utils.HEADER_SIGNATURE, "bob", "report.bin", "", str(len(junk))]),
+                                 io.BytesIO(junk), len(junk), None)
+            mallory.send_private("bob", "still here")
+            event = bob_files.get(timeout=5)
+            assert event.kind == "private" and event.text == "still here"
+            assert server.metrics["signatures_dropped"] == 5001
+
+            mallory.close()
+            alice.close()
+            bob.close()
+
 if __name__ == "__main__":
     test_connection()
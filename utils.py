@@ -1,10 +1,21 @@
+import hashlib
+import os
+import select
 import socket
+import ssl
+import struct
+import subprocess
 
 # Network Constants
 HOST = '0.0.0.0'  # Listen on all available interfaces
 PORT = 55556
 BUFFER_SIZE = 1024
+RELAY_BUFFER_SIZE = 64 * 1024  # Chunk size for file data (several TLS records per read)
 FORMAT = 'utf-8'
+POLL_INTERVAL = 0.5  # How often idle server loops check for drain/hot restart
+LOGIN_TIMEOUT = 10  # Seconds a new connection gets to finish TLS and send its username
+DRAIN_TIMEOUT = 10  # Seconds a drain or hot restart waits on a frame in flight before dropping its sender
+DEBUG = bool(os.environ.get("CHAT_DEBUG"))  # Per-message client logging is off unless asked for
 
 # Protocol Constants
 SEPARATOR = "<SEP>"
@@ -13,11 +24,204 @@ HEADER_PVT = "PVT"
 HEADER_FILE = "FILE"
 HEADER_LIST = "LIST"
 HEADER_ERR = "ERR"
+HEADER_SEARCH = "SEARCH"
+# Content-addressed sharing: OFFER a hash, answer the challenge with a PROOF, UPLOAD only if asked;
+# recipients get BLOB and FETCH it
+HEADER_OFFER = "OFFER"
+HEADER_UPLOAD = "UPLOAD"
+HEADER_SHARED = "SHARED"
+HEADER_BLOB = "BLOB"
+HEADER_FETCH = "FETCH"
+HEADER_BLOBDATA = "BLOBDATA"
+HEADER_PROOF = "PROOF"  # Answers the server's challenge to an OFFER; see possession_proof()
+# Delta transfer: ask the target for its SIGNATURE of the last version it got, then send a DELTA
+HEADER_SIGREQ = "SIGREQ"
+HEADER_SIGNATURE = "SIGNATURE"
+HEADER_DELTA = "DELTA"
+SEARCH_LIMIT = 20  # Hits returned per SEARCH
+BLOB_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "blob_store")
+BLOB_MAX_MB = 2048
+HISTORY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "chat_history.log")  # Searchable messages
+DELTA_MIN_SIZE = 64 * 1024  # Smaller files aren't worth the signature round trip
+SIGNATURE_TIMEOUT = 5  # Seconds to wait for a signature before sending the whole file
+SIGNATURE_MAX_SIZE = 16 * 1024 * 1024  # Covers files to ~50 GB at 64 KB blocks; larger ones go in full
+PROOF_RANGE = 64 * 1024  # Bytes of a file hashed to prove it is held, not just its hash
+
+# Default server rate limits (per second; 0 = unlimited)
+USER_MSG_RATE = 20
+IP_MSG_RATE = 50
+USER_BYTE_RATE = 64 * 1024
+IP_BYTE_RATE = 256 * 1024
+USER_FILE_RATE = 0
+IP_FILE_RATE = 0
+
+# Every control message is sent as a 4-byte big-endian length followed by the
+# payload, so a buffered reader knows exactly where a header ends and raw file
+# bytes begin (plain TCP and TLS alike).
+FRAME_HEADER = struct.Struct("!I")
+
+# TLS sessions remembered per (host, port) so reconnects can skip the full handshake
+_tls_sessions = {}
+
+def debug(message):
+    if DEBUG:
+        print(f"[DEBUG] {message}")
+
+def possession_proof(path, nonce):
+    """sha256 of the nonce and the PROOF_RANGE bytes of the file at an offset the nonce picks.
+
+    Cheap to compute, but needs the file itself: knowing its hash isn't enough.
+    """
+    with open(path, 'rb') as f:
+        size = f.seek(0, 2)
+        f.seek(int(nonce, 16) % max(1, size - PROOF_RANGE + 1))
+        return hashlib.sha256(bytes.fromhex(nonce) + f.read(PROOF_RANGE)).hexdigest()
+
+def send_frame(sock, payload):
+    """Send one length-prefixed frame."""
+    sock.sendall(FRAME_HEADER.pack(len(payload)) + payload)
+
+def recv_frame(reader):
+    """Read one length-prefixed frame from a buffered reader. Returns None on EOF."""
+    prefix = reader.read(FRAME_HEADER.size)
+    if len(prefix) < FRAME_HEADER.size:
+        return None
+    (length,) = FRAME_HEADER.unpack(prefix)
+    payload = reader.read(length)
+    if len(payload) < length:
+        return None
+    return payload
 
 def send_msg(sock, header, content):
     """Helper to send a formatted message."""
     try:
         msg = f"{header}{SEPARATOR}{content}"
-        sock.send(msg.encode(FORMAT))
+        send_frame(sock, msg.encode(FORMAT))
     except Exception as e:
         print(f"Error sending message: {e}")
+
+def recv_msg(reader):
+    """Read one message frame and decode it. Returns None on EOF."""
+    payload = recv_frame(reader)
+    if payload is None:
+        return None
+    return payload.decode(FORMAT)
+
+class FrameReader:
+    """Buffered reader over a socket whose unread bytes can be inspected and handed over.
+
+    Reads ahead in RELAY_BUFFER_SIZE chunks like a BufferedReader, but exposes
+    the buffer so the server can tell whether a whole frame is waiting and can
+    pass leftover bytes to another process on hot restart.
+    """
+
+    def __init__(self, sock, pending=b""):
+        self.sock = sock
+        self.buffer = bytearray(pending)
+
+    def _fill(self, size):
+        while len(self.buffer) < size:
+            data = self.sock.recv(max(RELAY_BUFFER_SIZE, size - len(self.buffer)))
+            if not data:
+                return False
+            self.buffer += data
+        return True
+
+    def read(self, size):
+        """Read exactly size bytes (fewer only at EOF)."""
+        self._fill(size)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def read1(self, size):
+        """Read up to size bytes with at most one recv()."""
+        if not self.buffer:
+            return self.sock.recv(size)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def has_frame(self):
+        """True if a complete frame is already buffered."""
+        if len(self.buffer) < FRAME_HEADER.size:
+            return False
+        (length,) = FRAME_HEADER.unpack_from(self.buffer)
+        return len(self.buffer) >= FRAME_HEADER.size + length
+
+    def wait(self, timeout):
+        """Wait up to timeout seconds for something to read. Returns False on timeout."""
+        if self.has_frame() or getattr(self.sock, "pending", lambda: 0)():
+            return True
+        readable, _, _ = select.select([self.sock], [], [], timeout)
+        return bool(readable)
+
+    def pending(self):
+        """Bytes received but not yet consumed."""
+        return bytes(self.buffer)
+
+    def close(self):
+        self.buffer.clear()
+
+def make_reader(sock, pending=b""):
+    """Wrap a socket in a buffered reader sized for file relays."""
+    return FrameReader(sock, pending)
+
+# TLS helpers
+
+def generate_self_signed_cert(certfile, keyfile, common_name="localhost"):
+    """Create a self-signed ECDSA P-256 certificate with the openssl CLI.
+
+    ECDSA keys make full handshakes far cheaper for the server than RSA-2048.
+    """
+    subprocess.run(
+        [
+            "openssl", "req", "-x509", "-nodes",
+            "-newkey", "ec", "-pkeyopt", "ec_paramgen_curve:prime256v1",
+            "-keyout", keyfile, "-out", certfile, "-days", "365",
+            "-subj", f"/CN={common_name}",
+            "-addext", f"subjectAltName=DNS:{common_name},IP:127.0.0.1",
+        ],
+        check=True,
+        capture_output=True,
+    )
+
+def make_server_context(certfile, keyfile):
+    """TLS context for the server. Session tickets are issued by default."""
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(certfile, keyfile)
+    return context
+
+def make_client_context(cafile=None):
+    """TLS context for clients; pass the server certificate as cafile when self-signed."""
+    context = ssl.create_default_context(cafile=cafile)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    return context
+
+def open_connection(host, port, tls_context=None, server_hostname=None):
+    """Connect to the server, resuming a cached TLS session when one is available."""
+    sock = socket.create_connection((host, port))
+    # Frames are small and latency-sensitive; don't let Nagle hold back handshake flights
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    if tls_context is None:
+        return sock
+    try:
+        return tls_context.wrap_socket(
+            sock,
+            server_hostname=server_hostname or host,
+            session=_tls_sessions.get((host, port)),
+        )
+    except Exception:
+        sock.close()
+        raise
+
+def save_tls_session(sock, host, port):
+    """Remember the session of a TLS socket for the next connection to host:port.
+
+    With TLS 1.3 the ticket arrives after the handshake, so call this once some
+    data has been read from the server.
+    """
+    session = getattr(sock, "session", None)
+    if session is not None and session.has_ticket:
+        _tls_sessions[(host, port)] = session